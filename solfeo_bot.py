@@ -1,28 +1,41 @@
-import argparse
+from __future__ import annotations
+
+import asyncio
+import collections
+import concurrent.futures
 import logging
+import operator
 import random
 import re
+import signal
 import sys
-from io import BytesIO
+from io import BytesIO, StringIO
 
-import matplotlib.pyplot as plt
-from matplotlib.patches import Ellipse
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
 import os
 import time
 import csv
-import math
-import statistics
+import functools
+import warnings
 from datetime import datetime
 from pathlib import Path
+from typing import TYPE_CHECKING, NamedTuple
 import getpass
-from telegram import Update
-from telegram.ext import (
-    ApplicationBuilder,
-    CommandHandler,
-    MessageHandler,
-    ContextTypes,
-    filters,
-)
+import hashlib
+import heapq
+import json
+import secrets
+import tempfile
+import threading
+import weakref
+
+# matplotlib y python-telegram-bot tardan en importarse y no hacen falta en
+# todos los caminos (p. ej. --help o el modo local sin gráficas): se importan
+# dentro de las funciones que los usan. Aquí solo para las anotaciones.
+if TYPE_CHECKING:
+    from telegram import Update
+    from telegram.ext import ContextTypes
 
 
 # =========================================================
@@ -110,7 +123,15 @@ SOLFEGE_TO_LETTER = {
 }
 
 
-def get_note_info(clef: str, staff_index: int) -> dict:
+class NoteInfo(NamedTuple):
+    pitch: str
+    letter: str
+    solfege: str
+    staff_index: int
+
+
+@functools.lru_cache(maxsize=64)
+def get_note_info(clef: str, staff_index: int) -> NoteInfo:
     """
     Devuelve información de la nota elegida por posición en el pentagrama.
 
@@ -120,6 +141,9 @@ def get_note_info(clef: str, staff_index: int) -> dict:
         2 = segunda línea, etc.
 
     Se permiten valores negativos y mayores que 8 (líneas adicionales).
+
+    El dominio es pequeño (~30 posiciones) y el resultado inmutable, así que
+    se memoiza.
     """
     if clef == "treble":
         pitches = TREBLE_PITCHES
@@ -137,18 +161,101 @@ def get_note_info(clef: str, staff_index: int) -> dict:
     letter = pitch_name[0]             # "C"
     solfege = LETTER_TO_SOLFEGE[letter]
 
-    return {
-        "pitch": pitch_name,
-        "letter": letter,
-        "solfege": solfege,
-        "staff_index": staff_index,
-    }
+    return NoteInfo(pitch_name, letter, solfege, staff_index)
+
+
+# Posiciones que se preguntan para cada clave:
+# -2 -> primera línea adicional por debajo
+# 12 -> segunda línea adicional por encima
+# recortadas a las que existen en la tabla de la clave.
+_VALID_INDICES = {
+    "treble": tuple(range(-2, min(13, len(TREBLE_PITCHES) - 2))),
+    "bass": tuple(range(-2, min(13, len(BASS_PITCHES) - 2))),
+}
+
+# Todas las notas que se pueden preguntar, como pares (clef, staff_index).
+# Ambas claves tienen el mismo número de posiciones, así que elegir de aquí
+# equivale a elegir clave al azar y luego posición.
+_ALL_NOTES = tuple(
+    (clef, staff_index)
+    for clef in ("treble", "bass")
+    for staff_index in _VALID_INDICES[clef]
+)
 
 
 # =========================================================
 # GENERACIÓN DE IMAGEN
 # =========================================================
 
+# Compresión zlib mínima para los PNG generados: son imágenes pequeñas y
+# Telegram las recomprime igualmente, así que no compensa gastar CPU en zlib.
+_PNG_FAST = {"compress_level": 1, "optimize": False}
+
+# PNG ya renderizados por (clef, staff_index). Solo hay ~30 combinaciones
+# posibles, así que guardamos los bytes y evitamos volver a dibujar.
+_NOTE_PNG_CACHE: dict[tuple[str, int], bytes] = {}
+
+# Geometría del pentagrama: rango visible en unidades (cada paso de
+# staff_index = 0.5) y escala en píxeles. El rango deja sitio para dos líneas
+# adicionales arriba y abajo con la cabeza de nota completa.
+_NOTE_X_RANGE = (-0.2, 10.5)
+_NOTE_Y_RANGE = (-1.5, 6.5)
+_NOTE_PX_PER_UNIT = 60  # 10.7 x 8 unidades -> 642 x 480 px
+_NOTE_SUPERSAMPLE = 4
+_NOTE_SCALE = _NOTE_PX_PER_UNIT * _NOTE_SUPERSAMPLE  # px/unidad al dibujar
+_NOTE_X = 8.0  # x de la cabeza de nota
+
+
+def _note_to_px(x: float, y: float) -> tuple[float, float]:
+    """Map staff units to pixels of the supersampled canvas (y grows downwards)."""
+    return ((x - _NOTE_X_RANGE[0]) * _NOTE_SCALE, (_NOTE_Y_RANGE[1] - y) * _NOTE_SCALE)
+
+
+def _ledger_line_ys(staff_index: int) -> list[float]:
+    """y de las líneas adicionales de una nota: solo índices pares fuera de 0..8."""
+    if staff_index > 8:
+        # primera línea adicional por encima: índice 10
+        line_indices = range(10, staff_index + 1, 2)
+    elif staff_index < 0:
+        # primera línea adicional por debajo: índice -2
+        line_indices = range(-2, staff_index - 1, -2)
+    else:
+        line_indices = range(0)
+    return [line_index * 0.5 for line_index in line_indices]
+
+
+# Segmentos del pentagrama (y = 0..4) y de las líneas adicionales de cada
+# posición, ya convertidos a píxeles: el render solo recorre tuplas.
+_STAFF_SEGMENTS = tuple(
+    (_note_to_px(1.3, y), _note_to_px(10.0, y)) for y in (0, 1, 2, 3, 4)
+)
+_LEDGER_SEGMENTS = {
+    staff_index: tuple(
+        (_note_to_px(_NOTE_X - 0.9, y), _note_to_px(_NOTE_X + 0.9, y))
+        for y in _ledger_line_ys(staff_index)
+    )
+    for indices in _VALID_INDICES.values()
+    for staff_index in indices
+}
+
+# Pool para renderizar fuera del event loop de asyncio: un render en frío no
+# debe bloquear el polling ni las respuestas a otros chats.
+_RENDER_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=os.cpu_count(), thread_name_prefix="render"
+)
+# Las gráficas de estadísticas (cientos de ms de matplotlib) van a un pool
+# aparte, para no competir con las notas.
+_PLOT_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=2, thread_name_prefix="plot"
+)
+# La E/S de ficheros de sesión (listarlos y añadir cada intento) tiene su
+# propio pool: si fuera al de las gráficas, dos /tiempos a la vez dejarían
+# esperando la respuesta de cada jugador en modo temporizado.
+_SESSION_IO_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=4, thread_name_prefix="session-io"
+)
+
+
 def generate_note_image(clef: str, staff_index: int) -> BytesIO:
     """
     Genera una imagen PNG en memoria con:
@@ -164,16 +271,59 @@ def generate_note_image(clef: str, staff_index: int) -> BytesIO:
       staff_index = 8  -> línea superior del pentagrama
 
     Cada paso (±1) equivale a 0.5 unidades en y.
+
+    El resultado se cachea por (clef, staff_index): las llamadas repetidas
+    devuelven un BytesIO nuevo sobre los mismos bytes sin volver a dibujar.
     """
-    # Figura suficientemente grande para que se vea bien en Telegram
-    fig, ax = plt.subplots(figsize=(6, 3))
+    key = (clef, staff_index)
+    cached = _NOTE_PNG_CACHE.get(key)
+    if cached is None:
+        cached = _render_note_png(clef, staff_index)
+        _NOTE_PNG_CACHE[key] = cached
+    return BytesIO(cached)
+
+
+def _load_note_font(size: int) -> ImageFont.ImageFont:
+    """Load the font for the clef label, falling back to Pillow's bundled font."""
+    try:
+        return ImageFont.truetype("DejaVuSans.ttf", size)
+    except OSError:
+        return ImageFont.load_default(size=size)
+
+
+@functools.lru_cache(maxsize=1)
+def _note_head_mask() -> Image.Image:
+    """Return the note-head mask: an ellipse rotated 20°, built once and reused.
+
+    Solo cambia la posición entre notas, así que la máscara (dibujar la
+    elipse recta y rotarla) se calcula una sola vez.
+    """
+    factor = 1.35
+    head_w = round(0.9 * factor * _NOTE_SCALE)
+    head_h = round(0.6 * factor * _NOTE_SCALE)
+    head = Image.new("L", (head_w, head_h), 0)
+    ImageDraw.Draw(head).ellipse((0, 0, head_w - 1, head_h - 1), fill=255)
+    return head.rotate(20, resample=Image.Resampling.BICUBIC, expand=True)
+
+
+def _render_note_png(clef: str, staff_index: int) -> bytes:
+    """Draw one note with Pillow and return the PNG bytes.
+
+    Se dibuja a _NOTE_SUPERSAMPLE veces el tamaño final y se reduce al
+    terminar, lo que suaviza los bordes de las líneas y de la elipse.
+    """
+    ss = _NOTE_SUPERSAMPLE
+    width = round((_NOTE_X_RANGE[1] - _NOTE_X_RANGE[0]) * _NOTE_PX_PER_UNIT)
+    height = round((_NOTE_Y_RANGE[1] - _NOTE_Y_RANGE[0]) * _NOTE_PX_PER_UNIT)
+
+    img = Image.new("RGB", (width * ss, height * ss), "white")
+    draw = ImageDraw.Draw(img)
 
     # -------------------------
     # Pentagrama principal (negro)
     # -------------------------
-    # Líneas en y = 0, 1, 2, 3, 4
-    for y in [0, 1, 2, 3, 4]:
-        ax.hlines(y, 1.3, 10.0, linewidth=1.8, color="black")
+    for segment in _STAFF_SEGMENTS:
+        draw.line(segment, fill="black", width=5 * ss)
 
     # -------------------------
     # Etiqueta de clave, centrada en la línea de referencia
@@ -189,87 +339,84 @@ def generate_note_image(clef: str, staff_index: int) -> BytesIO:
         clef_staff_index = 6  # línea de FA (F3)
 
     clef_y = clef_staff_index * 0.5
-
-    ax.text(
-        0.6,               # x
-        clef_y,            # y, sobre la línea de referencia
+    draw.text(
+        _note_to_px(0.6, clef_y),
         clef_label,
-        fontsize=18,
-        ha="center",
-        va="center",
-        color="black",
+        fill="black",
+        font=_load_note_font(50 * ss),
+        anchor="mm",
     )
 
     # -------------------------
     # Nota
     # -------------------------
     # cada step = 0.5 en y
-    note_x = 8.0
     note_y = staff_index * 0.5
-    
-    # Cabeza de nota: elipse negra ligeramente inclinada
-    factor = 1.35
-    note_head = Ellipse(
-        (note_x, note_y),
-        width=0.9*factor,
-        height=0.6*factor,
-        angle=20,
-        facecolor="black",
-        edgecolor="black",
-    )
-    ax.add_patch(note_head)
+
+    # Cabeza de nota: elipse negra ligeramente inclinada, pegada centrada en
+    # su posición a través de la máscara compartida
+    head = _note_head_mask()
+    cx, cy = _note_to_px(_NOTE_X, note_y)
+    left = round(cx - head.width / 2)
+    top = round(cy - head.height / 2)
+    img.paste("black", (left, top, left + head.width, top + head.height), head)
 
     # -------------------------
     # Líneas adicionales (ledger lines), en negro
     # -------------------------
-    # Solo para índices fuera de 0..8, y solo en índices pares (líneas)
-    # Por encima del pentagrama
-    if staff_index > 8:
-        # primera línea adicional por encima: índice 10
-        for line_index in range(10, staff_index + 1, 2):
-            y_line = line_index * 0.5
-            ax.hlines(
-                y_line,
-                note_x - 0.9,
-                note_x + 0.9,
-                linewidth=1.5,
-                color="black",
-            )
+    for segment in _LEDGER_SEGMENTS[staff_index]:
+        draw.line(segment, fill="black", width=4 * ss)
 
-    # Por debajo del pentagrama
-    if staff_index < 0:
-        # primera línea adicional por debajo: índice -2
-        for line_index in range(-2, staff_index - 1, -2):
-            y_line = line_index * 0.5
-            ax.hlines(
-                y_line,
-                note_x - 0.9,
-                note_x + 0.9,
-                linewidth=1.5,
-                color="black",
-            )
+    img = img.reduce(ss)
 
-    # -------------------------
-    # Ajustes de eje
-    # -------------------------
-    # Rango suficiente para dos líneas auxiliares arriba y abajo
-    ax.set_xlim(-0.2, 10.5)
-    ax.set_ylim(-2.0, 6.0)
+    buf = BytesIO()
+    img.save(buf, "PNG", **_PNG_FAST)
+    return buf.getvalue()
 
-    ax.set_aspect("equal", adjustable="box")
-    ax.axis("off")
 
-    buf = BytesIO()
-    fig.savefig(buf, format="png", dpi=580, bbox_inches="tight", pad_inches=0.05)
-    plt.close(fig)
-    buf.seek(0)
-    return buf
+@functools.lru_cache(maxsize=64)
+def _note_array(clef: str, staff_index: int) -> np.ndarray:
+    """Imagen de la nota ya decodificada (para imshow en el modo local).
+
+    Se cachea junto al PNG: las rondas siguientes con la misma nota no vuelven
+    a descomprimir la imagen. El array es compartido y de solo lectura.
+    """
+    return _decode_png(generate_note_image(clef, staff_index))
+
+
+def _decode_png(buf: BytesIO) -> np.ndarray:
+    """Decode a PNG with Pillow into a read-only uint8 array.
+
+    imshow takes uint8 pixels as they are, so there is no need for the float
+    [0, 1] copy that matplotlib's imread would build.
+    """
+    with Image.open(buf) as im:
+        img = np.asarray(im)
+    img.setflags(write=False)
+    return img
+
+
+def warm_note_image_cache() -> None:
+    """Pre-render every valid (clef, staff_index) so no request pays the render cost."""
+    for clef, indices in _VALID_INDICES.items():
+        for staff_index in indices:
+            generate_note_image(clef, staff_index)
 
 
 # =========================================================
 # LÓGICA DE RESPUESTAS
 # =========================================================
 
+# Tabla para normalize_answer: quita acentos básicos y elimina los dígitos
+_ANSWER_TRANSLATION = str.maketrans(
+    {"ó": "o", "á": "a", "é": "e", "í": "i", "ú": "u", **dict.fromkeys("0123456789")}
+)
+
+# Respuestas aceptadas, ya normalizadas (minúsculas, sin acentos ni octava)
+_ANSWER_MAP = {**SOLFEGE_TO_LETTER, **{c: c.upper() for c in "abcdefg"}}
+
+
+@functools.lru_cache(maxsize=256)
 def normalize_answer(text: str):
     """
     Convierte la respuesta del usuario a una letra de nota canónica: C, D, E, F, G, A, B.
@@ -278,33 +425,34 @@ def normalize_answer(text: str):
       - "do, re, mi, fa, sol, la, si"
       - "C, D, E, F, G, A, B"
       - con o sin número de octava (C4, do4, etc.).
+
+    Las respuestas se repiten mucho ("do", "Re", "sol4"...), así que el
+    resultado se memoriza por texto exacto: una respuesta ya vista se
+    reconoce con una sola búsqueda.
     """
-    t = text.strip().lower()
-    # Quitar acentos básicos
-    t = (
-        t.replace("ó", "o")
-         .replace("á", "a")
-         .replace("é", "e")
-         .replace("í", "i")
-         .replace("ú", "u")
-    )
+    # Quitar acentos básicos y dígitos (octava) en una sola pasada
+    t = text.strip().lower().translate(_ANSWER_TRANSLATION)
 
-    # Quitar dígitos (octava)
-    t = re.sub(r"\d", "", t)
+    letter = _ANSWER_MAP.get(t)
+    if letter is None and t:
+        # Letras inglesas seguidas de otros signos ("c#", "bb"): vale la inicial
+        letter = _ANSWER_MAP.get(t[0])
+    return letter
 
-    # Solfeo completo
-    if t in SOLFEGE_TO_LETTER:
-        return SOLFEGE_TO_LETTER[t]
 
-    # Letras inglesas
-    if len(t) == 0:
-        return None
+# file_id de Telegram de cada imagen de nota ya subida, por (clef, staff_index).
+# Los file_id son válidos para cualquier chat del mismo bot.
+_NOTE_FILE_IDS: dict[tuple[str, int], str] = {}
 
-    first = t[0]
-    if first.upper() in ["A", "B", "C", "D", "E", "F", "G"]:
-        return first.upper()
 
-    return None
+# Pie de foto de cada nota: solo depende de la clave, se construye una vez
+_NOTE_CAPTIONS = {
+    clef: (
+        f"¿Qué nota es esta en {clef_name}?\n"
+        "Puedes responder con do, re, mi... o con letras (C, D, E...)."
+    )
+    for clef, clef_name in (("treble", "clave de sol"), ("bass", "clave de fa"))
+}
 
 
 async def send_new_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -312,50 +460,48 @@ async def send_new_note(update: Update, context: ContextTypes.DEFAULT_TYPE):
     Genera una nueva nota aleatoria (clave y posición) y la envía al usuario.
     Guarda la solución en context.user_data.
     """
-    # Elegir clave aleatoriamente (sol o fa)
-    clef = random.choice(["treble", "bass"])
-
-    # Rango de posiciones:
-    # -2 -> primera línea adicional por debajo
-    # 12 -> segunda línea adicional por encima
-    staff_index = random.randint(-2, 12)
-
-    # Garantizar que la nota está en el rango de la tabla para esa clave
-    while True:
-        try:
-            note_info = get_note_info(clef, staff_index)
-            break
-        except ValueError:
-            staff_index = random.randint(-2, 12)
+    # Elegir clave y posición válida de una sola vez (ver _ALL_NOTES)
+    clef, staff_index = random.choice(_ALL_NOTES)
+    note_info = get_note_info(clef, staff_index)
 
     # Guardar la nota esperada para este usuario
     context.user_data["current_note"] = {
         "clef": clef,
         "staff_index": staff_index,
-        "pitch": note_info["pitch"],
-        "letter": note_info["letter"],
-        "solfege": note_info["solfege"],
+        "pitch": note_info.pitch,
+        "letter": note_info.letter,
+        "solfege": note_info.solfege,
     }
     # Reset consecutive-invalid counter when a new note is issued
     context.user_data["invalid_count"] = 0
 
-    buf = generate_note_image(clef, staff_index)
+    # Si esta imagen ya se subió antes, reenviamos su file_id de Telegram en
+    # lugar de volver a subir el PNG.
+    file_id = _NOTE_FILE_IDS.get((clef, staff_index))
+    if file_id is not None:
+        photo = file_id
+    else:
+        photo = await asyncio.get_running_loop().run_in_executor(
+            _RENDER_POOL, generate_note_image, clef, staff_index
+        )
 
-    # If running in timed mode, record the timestamp when the note was shown
-    # so we can measure response time.
+    # If running in timed mode, record when the note was shown (monotonic
+    # clock, immune to wall-clock adjustments) so we can measure response time.
     try:
         if context and isinstance(context.user_data, dict) and context.user_data.get("mode") == "time":
-            context.user_data["last_shown_ts"] = time.time()
+            context.user_data["last_shown_ts"] = time.monotonic_ns()
     except Exception:
         pass
 
-    clef_name = "clave de sol" if clef == "treble" else "clave de fa"
-    caption = (
-        f"¿Qué nota es esta en {clef_name}?\n"
-        "Puedes responder con do, re, mi... o con letras (C, D, E...)."
-    )
+    message = await update.effective_chat.send_photo(photo=photo, caption=_NOTE_CAPTIONS[clef])
+    if file_id is None and message.photo:
+        _NOTE_FILE_IDS[(clef, staff_index)] = message.photo[-1].file_id
 
-    await update.effective_chat.send_photo(photo=buf, caption=caption)
+
+# Caracteres no permitidos en nombres de usuario usados como rutas. \w (en
+# Unicode) conserva las mismas letras y dígitos que str.isalnum, de modo que
+# los directorios ya existentes de cada usuario no cambian.
+_UNSAFE_USERNAME_RE = re.compile(r"[^\w-]+")
 
 
 def _safe_username_from_update(update: Update) -> str:
@@ -365,140 +511,407 @@ def _safe_username_from_update(update: Update) -> str:
         return "local"
     name = user.username or f"{user.first_name or 'user'}_{user.id}"
     # sanitize: keep alphanum, dash and underscore
-    safe = "".join(c for c in name if c.isalnum() or c in ("-","_"))
+    safe = _UNSAFE_USERNAME_RE.sub("", name)
     return safe or "user"
 
 
+# Columnas de los CSV de sesión
+_SESSION_FIELDS = ["timestamp", "clef", "letter", "solfege", "correct", "time_seconds"]
+# Las estadísticas solo usan estas columnas (y estos tipos): al leer se
+# seleccionan por posición y el timestamp y el solfeo ni siquiera se decodifican.
+_STATS_DTYPE = np.dtype([
+    ("clef", "U8"),
+    ("letter", "U1"),
+    ("correct", "i1"),
+    ("time_seconds", "f8"),
+])
+_STATS_USECOLS = tuple(_SESSION_FIELDS.index(name) for name in _STATS_DTYPE.names)
+
+
+def _user_sessions_dir(username: str) -> Path:
+    # Sessions live under SESSIONS/SAVED_GAMES/<username>/
+    return Path.cwd() / "SESSIONS" / "SAVED_GAMES" / username
+
+
 def _ensure_user_dir(username: str) -> Path:
-    # Save sessions under SESSIONS/SAVED_GAMES/<username>/
-    base = Path.cwd() / "SESSIONS" / "SAVED_GAMES" / username
+    base = _user_sessions_dir(username)
     base.mkdir(parents=True, exist_ok=True)
     return base
 
 
-def _save_session_records(username: str, records: list[dict]) -> Path:
-    """Save session records (list of dicts) to CSV under sessions/<username>/session_YYYYmmdd_HHMMSS.csv
-    Returns path to file.
+def _format_timestamp(ts) -> str:
+    """ISO text for a record timestamp given either as epoch seconds or as text."""
+    if isinstance(ts, float):
+        return datetime.fromtimestamp(ts).isoformat()
+    return ts
+
+
+def _format_session_rows(records: list[dict], header: bool = True) -> str:
+    """Serialize session records as CSV text (columns in _SESSION_FIELDS order).
+
+    The timestamp may be epoch seconds (time.time()); it is turned into ISO
+    text here so the answer handler does not have to format it.
+    """
+    out = StringIO()
+    writer = csv.writer(out)
+    if header:
+        writer.writerow(_SESSION_FIELDS)
+    writer.writerows(_session_row(r) for r in records)
+    return out.getvalue()
+
+
+def _session_row(r: dict) -> tuple:
+    """One record as a tuple in _SESSION_FIELDS order, as written to the CSV."""
+    return (
+        _format_timestamp(r.get("timestamp")),
+        r.get("clef"),
+        r.get("letter"),
+        r.get("solfege"),
+        int(bool(r.get("correct"))),
+        float(r.get("time_seconds") or 0),
+    )
+
+
+def _new_session_path(username: str) -> Path:
+    """Return the CSV path for a new session; the file is created on the first append.
+
+    The name only has one-second resolution: _create_session_file picks
+    another one if a session started in the same second already took it.
     """
-    if not records:
-        raise ValueError("No records to save")
     user_dir = _ensure_user_dir(username)
-    fname = f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
-    p = user_dir / fname
-    fieldnames = ["timestamp", "clef", "letter", "solfege", "correct", "time_seconds"]
-    with p.open("w", newline='', encoding='utf-8') as f:
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for r in records:
-            writer.writerow({
-                "timestamp": r.get("timestamp"),
-                "clef": r.get("clef"),
-                "letter": r.get("letter"),
-                "solfege": r.get("solfege"),
-                "correct": int(bool(r.get("correct"))),
-                "time_seconds": float(r.get("time_seconds") or 0),
-            })
-    return p
+    return user_dir / f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
 
 
-def _list_user_sessions(username: str) -> list[Path]:
-    user_dir = Path.cwd() / "SESSIONS" / "SAVED_GAMES" / username
-    if not user_dir.exists():
+def _create_session_file(path: Path):
+    """Create ``path`` exclusively (or ``<stem>_<n>.csv`` if it exists); return (file, path)."""
+    candidate = path
+    n = 1
+    while True:
+        try:
+            return candidate.open("x", newline='', encoding='utf-8'), candidate
+        except FileExistsError:
+            candidate = path.with_name(f"{path.stem}_{n}{path.suffix}")
+            n += 1
+
+
+def _append_session_records(path: Path, records: list[dict], new: bool = False) -> Path:
+    """Append records to a session CSV, writing the header if the file is new.
+
+    Timed sessions (Telegram and local) call this once per answer, so the
+    data is on disk as it is produced instead of only when the session ends.
+    With ``new`` (the session's first answer) the file is created
+    exclusively, so two sessions never share one CSV; the path actually
+    written is returned and is the one to pass for the following appends.
+    """
+    if new:
+        f, path = _create_session_file(path)
+    else:
+        f = path.open("a", newline='', encoding='utf-8')
+    with f:
+        is_new = f.tell() == 0
+        before = None if is_new else _file_version(os.fstat(f.fileno()))
+        f.write(_format_session_rows(records, header=is_new))
+    _cache_appended_records(path, before, records)
+    return path
+
+
+# username -> (mtime del directorio, [(mtime, ruta) de cada CSV]); crear o
+# borrar una sesión cambia el mtime del directorio e invalida la entrada.
+_SESSION_LIST_CACHE: dict[str, tuple[int, list[tuple[float, Path]]]] = {}
+
+
+def _scan_user_sessions(username: str) -> list[tuple[float, Path]]:
+    user_dir = _user_sessions_dir(username)
+    try:
+        dir_mtime = user_dir.stat().st_mtime_ns
+    except FileNotFoundError:
         return []
-    files = sorted([p for p in user_dir.iterdir() if p.suffix == ".csv"], key=lambda x: x.stat().st_mtime, reverse=True)
-    return files
+    cached = _SESSION_LIST_CACHE.get(username)
+    if cached is not None and cached[0] == dir_mtime:
+        return cached[1]
+    with os.scandir(user_dir) as it:
+        entries = [
+            (e.stat().st_mtime, Path(e.path))
+            for e in it
+            if e.name.endswith(".csv") and e.is_file()
+        ]
+    _SESSION_LIST_CACHE[username] = (dir_mtime, entries)
+    return entries
+
+
+def _list_user_sessions(username: str, n: int | None = None) -> list[Path]:
+    """Session CSVs of ``username``, newest first; only the newest ``n`` if given."""
+    entries = _scan_user_sessions(username)
+    key = operator.itemgetter(0)
+    if n is None:
+        newest = sorted(entries, key=key, reverse=True)
+    else:
+        newest = heapq.nlargest(n, entries, key=key)
+    return [path for _, path in newest]
 
 
 def _settings_dir() -> Path:
-    d = Path.cwd() / "SESSIONS" / "SETTINGS"
-    d.mkdir(parents=True, exist_ok=True)
-    return d
+    # Solo construye la ruta: el directorio se crea al escribir
+    # (_write_json_atomic), no en cada lectura de ajustes
+    return Path.cwd() / "SESSIONS" / "SETTINGS"
+
 
+def _user_settings_file(username: str) -> Path:
+    return _settings_dir() / f"{username}.json"
 
-def _user_lang_file(username: str) -> Path:
-    return _settings_dir() / f"{username}.lang"
 
+def _legacy_settings_files(username: str) -> dict[str, Path]:
+    """Per-key files used before settings were merged into <username>.json."""
+    d = _settings_dir()
+    return {"lang": d / f"{username}.lang", "system": d / f"{username}.system"}
 
-def _user_system_file(username: str) -> Path:
-    return _settings_dir() / f"{username}.system"
+
+def _write_json_atomic(path: Path, data: dict) -> None:
+    """Write JSON to a temp file in the same directory and os.replace it into place."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+def _migrate_legacy_settings(username: str) -> dict:
+    """Fold old <username>.lang / <username>.system files into <username>.json."""
+    settings = {}
+    legacy = _legacy_settings_files(username)
+    for key, p in legacy.items():
+        if p.exists():
+            txt = p.read_text(encoding='utf-8').strip()
+            if txt:
+                settings[key] = txt
+    if settings:
+        _write_json_atomic(_user_settings_file(username), settings)
+        for p in legacy.values():
+            p.unlink(missing_ok=True)
+        logger.info("Migrated legacy settings for %s to %s", username, _user_settings_file(username))
+    return settings
+
+
+# username -> (versión (mtime, tamaño) del fichero o None si no existe,
+# ajustes guardados). Un stat basta para validar la entrada, así que un
+# fichero editado a mano (o por otro proceso) se vuelve a leer.
+_USER_CFG_CACHE: dict[str, tuple[tuple[int, int] | None, dict]] = {}
+
+
+def _settings_version(p: Path) -> tuple[int, int] | None:
+    try:
+        return _file_version(p.stat())
+    except FileNotFoundError:
+        return None
+
+
+def _load_user_settings(username: str) -> dict:
+    p = _user_settings_file(username)
+    if not p.exists():
+        return _migrate_legacy_settings(username)
+    try:
+        data = json.loads(p.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        logger.warning("Could not read settings file %s; ignoring it", p)
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _read_user_settings(username: str) -> dict:
+    """Return the saved settings of a user ({} if none), from _USER_CFG_CACHE.
+
+    The entry is reused while the settings file keeps its mtime and size.
+    The returned dict is shared by the cache: do not mutate it.
+    """
+    version = _settings_version(_user_settings_file(username))
+    cached = _USER_CFG_CACHE.get(username)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    settings = _load_user_settings(username)
+    _USER_CFG_CACHE[username] = (version, settings)
+    return settings
+
+
+def _update_user_settings(username: str, **changes: str) -> Path:
+    """Merge changes into the user's settings file (atomically) and its cache entry."""
+    p = _user_settings_file(username)
+    settings = {**_read_user_settings(username), **changes}
+    _write_json_atomic(p, settings)
+    _USER_CFG_CACHE[username] = (_settings_version(p), settings)
+    return p
 
 
 def _read_user_system(username: str) -> str | None:
-    p = _user_system_file(username)
-    if p.exists():
-        txt = p.read_text(encoding='utf-8').strip()
-        if txt:
-            return txt
-    return None
+    return _read_user_settings(username).get("system") or None
 
 
 def _write_user_system(username: str, system: str) -> Path:
-    p = _user_system_file(username)
-    p.write_text(system.strip(), encoding='utf-8')
-    return p
+    return _update_user_settings(username, system=system.strip())
 
 
 def _read_user_language(username: str) -> str | None:
-    p = _user_lang_file(username)
-    if p.exists():
-        txt = p.read_text(encoding='utf-8').strip()
-        if txt:
-            return txt
-    return None
+    return _read_user_settings(username).get("lang") or None
 
 
 def _write_user_language(username: str, lang: str) -> Path:
-    p = _user_lang_file(username)
-    p.write_text(lang.strip(), encoding='utf-8')
-    return p
+    return _update_user_settings(username, lang=lang.strip())
+
+
+def _read_session_csv(path: Path) -> np.ndarray:
+    """Load the statistics columns of a session CSV into a _STATS_DTYPE array.
+
+    np.loadtxt parses the whole file in C instead of building a dict per row;
+    the header is skipped and columns are picked by their fixed position.
+    """
+    with warnings.catch_warnings():
+        # a session file with only the header is valid: no rows, no warning
+        warnings.simplefilter("ignore", UserWarning)
+        return np.loadtxt(
+            path,
+            dtype=_STATS_DTYPE,
+            delimiter=",",
+            skiprows=1,
+            usecols=_STATS_USECOLS,
+            ndmin=1,
+            encoding="utf-8",
+        )
+
+
+# Contenido ya parseado de los CSV de sesión: ruta -> ((st_mtime_ns, st_size),
+# registros). El tamaño acompaña al mtime porque en sistemas de ficheros con
+# mtime de poca resolución dos escrituras seguidas pueden dejar el mismo mtime.
+# Lo rellena también _append_session_records con lo que acaba de escribir, de
+# modo que /tiempos justo después de jugar no vuelve a leer ni parsear el CSV.
+_SESSION_CACHE: collections.OrderedDict[str, tuple[tuple[int, int], np.ndarray]] = collections.OrderedDict()
+_SESSION_CACHE_MAX = 64
+_SESSION_CACHE_LOCK = threading.Lock()
 
 
-def _read_session_csv(path: Path) -> list[dict]:
-    recs = []
-    with path.open("r", encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            recs.append({
-                "timestamp": row.get("timestamp"),
-                "clef": row.get("clef"),
-                "letter": row.get("letter"),
-                "solfege": row.get("solfege"),
-                "correct": bool(int(row.get("correct", "0"))),
-                "time_seconds": float(row.get("time_seconds", "0")),
-            })
-    return recs
+def _file_version(st: os.stat_result) -> tuple[int, int]:
+    return st.st_mtime_ns, st.st_size
 
 
-def _aggregate_records(records: list[dict]):
-    """Aggregate records per clef and letter. Returns dict[clef][letter] -> dict(stats).
+def _store_session_cache(key: str, version: tuple[int, int], records: np.ndarray) -> None:
+    with _SESSION_CACHE_LOCK:
+        _SESSION_CACHE[key] = (version, records)
+        _SESSION_CACHE.move_to_end(key)
+        while len(_SESSION_CACHE) > _SESSION_CACHE_MAX:
+            _SESSION_CACHE.popitem(last=False)
 
-    stats include: attempts, corrects, times_correct (list), avg_time_correct, std_time_correct, success_rate
+
+def _cache_appended_records(path: Path, before: tuple[int, int] | None, records: list[dict]) -> None:
+    """Extend the cached content of ``path`` with rows that were just appended.
+
+    ``before`` is the file's (mtime, size) before the append (None for a new
+    file). If the cache does not hold exactly that version, the entry is left
+    alone and the next read parses the file again.
+    """
+    key = str(path)
+    new_rows = np.fromiter(
+        (tuple(row[i] for i in _STATS_USECOLS) for row in map(_session_row, records)),
+        dtype=_STATS_DTYPE,
+        count=len(records),
+    )
+    with _SESSION_CACHE_LOCK:
+        cached = _SESSION_CACHE.get(key)
+    if before is None:
+        content = new_rows
+    elif cached is not None and cached[0] == before:
+        content = np.concatenate([cached[1], new_rows])
+    else:
+        return
+    _store_session_cache(key, _file_version(path.stat()), content)
+
+
+def _read_session_csv_cached(path: Path) -> np.ndarray:
+    """_read_session_csv, served from _SESSION_CACHE while the file is unchanged."""
+    key = str(path)
+    version = _file_version(path.stat())
+    with _SESSION_CACHE_LOCK:
+        cached = _SESSION_CACHE.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    records = _read_session_csv(path)
+    _store_session_cache(key, version, records)
+    return records
+
+
+# Orden fijo de claves y notas: las estadísticas son matrices [clave, nota]
+_CLEFS_ORDER = ("treble", "bass")
+_NOTES_ORDER = ("C", "D", "E", "F", "G", "A", "B")
+_STATS_SHAPE = (len(_CLEFS_ORDER), len(_NOTES_ORDER))
+
+
+def _category_index(values: np.ndarray, order: tuple[str, ...]) -> np.ndarray:
+    """Position of each value in ``order`` (-1 for values not in it)."""
+    uniq, inverse = np.unique(values, return_inverse=True)
+    lookup = np.array([order.index(u) if u in order else -1 for u in uniq.tolist()], dtype=np.intp)
+    return lookup[inverse.ravel()]
+
+
+def _session_sums(records: np.ndarray) -> np.ndarray:
+    """Sums [attempts, corrects, sum_t, sum_t2] per [clef, note], shape (4, 2, 7).
+
+    Only correct answers contribute to the time sums. The sums of several
+    files can simply be added together, so a whole history can be aggregated
+    one file at a time.
+    """
+    sums = np.zeros((4, *_STATS_SHAPE))
+    if len(records) == 0:
+        return sums
+
+    clef_idx = _category_index(records["clef"], _CLEFS_ORDER)
+    note_idx = _category_index(records["letter"], _NOTES_ORDER)
+    valid = (clef_idx >= 0) & (note_idx >= 0)
+    cell = (clef_idx * len(_NOTES_ORDER) + note_idx)[valid]
+    correct = records["correct"][valid].astype(bool)
+    times_correct = np.where(correct, records["time_seconds"][valid], 0.0)
+
+    size = sums[0].size
+    sums[0].flat = np.bincount(cell, minlength=size)
+    sums[1].flat = np.bincount(cell, weights=correct, minlength=size)
+    sums[2].flat = np.bincount(cell, weights=times_correct, minlength=size)
+    sums[3].flat = np.bincount(cell, weights=times_correct * times_correct, minlength=size)
+    return sums
+
+
+def _stats_from_sums(sums: np.ndarray) -> dict[str, np.ndarray]:
+    """Turn _session_sums output into per-statistic [clef, note] arrays.
+
+    keys: attempts, corrects, avg_time_correct, std_time_correct, success_rate, success_se
     """
-    agg = {}
-    for r in records:
-        clef = r.get("clef", "unknown")
-        letter = r.get("letter", "?")
-        agg.setdefault(clef, {})
-        bucket = agg[clef].setdefault(letter, {"attempts": 0, "corrects": 0, "times_correct": []})
-        bucket["attempts"] += 1
-        if r.get("correct"):
-            bucket["corrects"] += 1
-            bucket["times_correct"].append(r.get("time_seconds", 0.0))
-
-    # compute derived stats
-    for clef, letters in agg.items():
-        for letter, data in letters.items():
-            attempts = data["attempts"]
-            corrects = data["corrects"]
-            times = data["times_correct"]
-            avg = statistics.mean(times) if times else 0.0
-            std = statistics.pstdev(times) if len(times) > 1 else 0.0
-            success_rate = (corrects / attempts * 100.0) if attempts > 0 else 0.0
-            # approximate deviation for success rate (percent) using binomial std
-            se = math.sqrt(success_rate/100.0 * (1 - success_rate/100.0) / attempts) * 100.0 if attempts > 0 else 0.0
-            data.update({"avg_time_correct": avg, "std_time_correct": std, "success_rate": success_rate, "success_se": se})
-
-    return agg
+    attempts, corrects, sum_t, sum_t2 = sums
+    zeros = np.zeros(_STATS_SHAPE)
+    avg = np.divide(sum_t, corrects, out=zeros.copy(), where=corrects > 0)
+    var = np.divide(sum_t2, corrects, out=zeros.copy(), where=corrects > 1) - avg * avg
+    std = np.where(corrects > 1, np.sqrt(np.clip(var, 0.0, None)), 0.0)
+    rate = np.divide(corrects, attempts, out=zeros.copy(), where=attempts > 0)
+    # approximate deviation for success rate (percent) using binomial std
+    se = np.sqrt(np.divide(rate * (1 - rate), attempts, out=zeros.copy(), where=attempts > 0))
+    return {
+        "attempts": attempts,
+        "corrects": corrects,
+        "avg_time_correct": avg,
+        "std_time_correct": std,
+        "success_rate": rate * 100.0,
+        "success_se": se * 100.0,
+    }
+
+
+def _aggregate_records_streaming(paths) -> dict[str, np.ndarray]:
+    """Aggregate several session CSVs per clef and note, one file at a time.
+
+    Only one file's records are in memory at once; each file's (4, 2, 7)
+    sums are added into a running total.
+    """
+    total = np.zeros((4, *_STATS_SHAPE))
+    for path in paths:
+        total += _session_sums(_read_session_csv_cached(path))
+    return _stats_from_sums(total)
 
 
 def restore_console_focus():
@@ -546,64 +959,195 @@ def restore_console_focus():
         pass
 
 
-def _menu_text_main() -> str:
-    return (
-        "Bienvenido a Solfeo — elige una opción para empezar:\n\n"
-        "• /play — comenzar a practicar (luego elige entre modos: free o time).\n"
-        "• /historial — ver opciones de historial y estadísticas (tiempos, aciertos, listado de partidas).\n"
-        "• /settings — configurar preferencia de idioma y sistema de notación.\n\n"
-        "En local puedes escribir 'play', 'historial' o 'settings' sin '/'.\n"
-    )
+# Bytes leídos de stdin que aún no forman (o siguen a) una línea completa
+_stdin_pending = bytearray()
 
 
-def _menu_text_play() -> str:
-    return (
-        "Modos de juego:\n\n"
-        "• Usa /free para modo libre — no guarda datos ni mide tiempos.\n"
-        "• Usa /time para iniciar sesión temporizada — se guardarán tiempos y aciertos.\n\n"
-        "En local puedes escribir 'free' o 'time' sin '/'.\n"
-    )
+def _input_with_gui(prompt: str, fig=None) -> str:
+    """input() that keeps a matplotlib figure responsive while waiting.
 
+    With a live ``fig`` on a POSIX terminal or pipe, stdin is polled with
+    select and the figure's GUI events are processed between polls (~20 Hz),
+    so the window can be moved, resized or closed while the console waits;
+    if it is closed, polling moves to another open figure, or to a blocking
+    read of stdin when none is left.
+    The canvas event loop is run directly rather than plt.pause, which would
+    re-show (and raise) the window on every poll. Without a figure it simply
+    blocks on stdin; on Windows, where select does not take console handles,
+    it is plain input(). Raises EOFError at end of input.
+    """
+    try:
+        fd = sys.stdin.fileno()
+    except (AttributeError, ValueError, OSError):
+        fd = None
+    if fd is None or os.name != "posix":
+        return input(prompt)
+
+    import select
+
+    sys.stdout.write(prompt)
+    sys.stdout.flush()
+    if fig is not None:
+        import matplotlib.pyplot as plt
+
+    def stop_polling(event):
+        # Cerrar la ventana durante start_event_loop anula el temporizador
+        # que lo termina; sin esto la consola no volvería hasta cerrar las demás
+        event.canvas.stop_event_loop()
+
+    cid = None
+    # stdin se lee en crudo (os.read) y no con sys.stdin.readline: el buffer
+    # de sys.stdin podría guardar líneas que select ya no vería
+    try:
+        while b"\n" not in _stdin_pending:
+            if fig is not None and not plt.fignum_exists(fig.number):
+                # Ventana cerrada: se sigue con otra abierta, o sin ninguna se
+                # espera bloqueado en stdin
+                nums = plt.get_fignums()
+                fig = plt.figure(nums[0]) if nums else None
+                cid = None
+            if fig is not None and cid is None:
+                cid = fig.canvas.mpl_connect("close_event", stop_polling)
+            ready, _, _ = select.select([fd], [], [], 0 if fig is not None else None)
+            if not ready:
+                fig.canvas.start_event_loop(0.05)
+                continue
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                if not _stdin_pending:
+                    raise EOFError
+                break
+            _stdin_pending.extend(chunk)
+    finally:
+        if fig is not None and cid is not None:
+            fig.canvas.mpl_disconnect(cid)
+    line, _, rest = bytes(_stdin_pending).partition(b"\n")
+    _stdin_pending[:] = rest
+    return line.decode(sys.stdin.encoding or "utf-8", errors="replace").rstrip("\r")
+
+
+# Textos de menú (estáticos, se construyen una sola vez al importar)
+_MENU_MAIN = (
+    "Bienvenido a Solfeo — elige una opción para empezar:\n\n"
+    "• /play — comenzar a practicar (luego elige entre modos: free o time).\n"
+    "• /historial — ver opciones de historial y estadísticas (tiempos, aciertos, listado de partidas).\n"
+    "• /settings — configurar preferencia de idioma y sistema de notación.\n\n"
+    "En local puedes escribir 'play', 'historial' o 'settings' sin '/'.\n"
+)
 
-def _menu_text_historial() -> str:
-    return (
-        "Historial y estadísticas:\n\n"
-        "• /tiempos [n] — genera gráficos de tiempos por nota para las últimas n sesiones.\n"
-        "• /aciertos [n] — genera gráficos de tasa de aciertos por nota para las últimas n sesiones.\n"
-        "• /old_games [n] — lista rápida de las últimas n partidas guardadas.\n\n"
-        "En local puedes escribir 'tiempos', 'aciertos' u 'old_games' sin '/'.\n"
-    )
+_MENU_PLAY = (
+    "Modos de juego:\n\n"
+    "• Usa /free para modo libre — no guarda datos ni mide tiempos.\n"
+    "• Usa /time para iniciar sesión temporizada — se guardarán tiempos y aciertos.\n\n"
+    "En local puedes escribir 'free' o 'time' sin '/'.\n"
+)
 
+_MENU_HISTORIAL = (
+    "Historial y estadísticas:\n\n"
+    "• /tiempos [n] — genera gráficos de tiempos por nota para las últimas n sesiones.\n"
+    "• /aciertos [n] — genera gráficos de tasa de aciertos por nota para las últimas n sesiones.\n"
+    "• /old_games [n] — lista rápida de las últimas n partidas guardadas.\n\n"
+    "En local puedes escribir 'tiempos', 'aciertos' u 'old_games' sin '/'.\n"
+)
 
-def _menu_text_settings() -> str:
-    return (
-        "Ajustes de usuario:\n\n"
-        "• /set_language — cambiar el idioma de los mensajes (es/en).\n"
-        "• /set_system — elegir el sistema de notación ('letter' o 'solfege').\n\n"
-        "En local puedes teclear 'set_language' o 'set_system'.\n"
-    )
+_MENU_SETTINGS = (
+    "Ajustes de usuario:\n\n"
+    "• /set_language [es|en] — cambiar el idioma de los mensajes.\n"
+    "• /set_system [letter|solfege] — elegir el sistema de notación.\n\n"
+    "En local puedes teclear 'set_language' o 'set_system'.\n"
+)
+
+# Palabras de primer nivel que, sin nota activa, muestran un menú
+_CMD_DISPATCH = {
+    "play": _MENU_PLAY,
+    "historial": _MENU_HISTORIAL,
+    "help": _MENU_MAIN,
+    "start": _MENU_MAIN,
+    "settings": _MENU_SETTINGS,
+}
 
 
 # =========================================================
 # HANDLERS DE TELEGRAM
 # =========================================================
 
+_SESSION_KEYS = ("session_count", "session_path", "mode", "current_note", "last_shown_ts")
+
+
+def _reset_session_state(user_data: dict) -> None:
+    """Forget the current game (mode, note, timed session) of a user."""
+    for key in _SESSION_KEYS:
+        user_data.pop(key, None)
+    user_data["invalid_count"] = 0
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Make /start behave the same as /help: show instructions and modes.
     await help_command(update, context)
 
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(_menu_text_main())
+    await update.message.reply_text(_MENU_MAIN)
 
 
 async def play_menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(_menu_text_play())
+    await update.message.reply_text(_MENU_PLAY)
+
+
+# Prefijo de la respuesta -> valor guardado: 'es'/'español'/'spanish',
+# 'en'/'english'; 'letter(s)'/'abc', 'sol(fege|feo)'/'do'/'doremi'
+_LANG_TABLE = {"es": "es", "sp": "es", "en": "en"}
+_SYS_TABLE = {"let": "letter", "abc": "letter", "sol": "solfege", "do": "solfege", "dor": "solfege"}
+
+
+def _parse_language(text: str) -> str | None:
+    """Código de idioma a partir de la respuesta del usuario (None si está vacía)."""
+    lang_try = (text or "").strip().lower()
+    if not lang_try:
+        return None
+    # normalize common names; accept raw two-letter codes
+    return _LANG_TABLE.get(lang_try[:2], lang_try[:2])
+
+
+def _parse_system(text: str) -> str | None:
+    """'letter' o 'solfege' a partir de la respuesta del usuario (None si no se reconoce)."""
+    return _SYS_TABLE.get((text or "").strip().lower()[:3])
+
+
+async def _store_language(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    lang = _parse_language(text)
+    if lang is None:
+        await update.message.reply_text("No se recibió un idioma válido. Intenta de nuevo: 'es' o 'en'.")
+        return
+    try:
+        _write_user_language(_safe_username_from_update(update), lang)
+        context.user_data["awaiting_language"] = False
+        await update.message.reply_text(f"Idioma almacenado: {lang}. Puedes usar /help para ver opciones.")
+    except Exception as e:
+        await update.message.reply_text(f"Error guardando la configuración: {e}")
+
+
+async def _store_system(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    if not (text or "").strip():
+        await update.message.reply_text("No se recibió un sistema válido. Escribe 'letter' o 'solfege'.")
+        return
+    system = _parse_system(text)
+    if system is None:
+        await update.message.reply_text("Opción no reconocida. Escribe 'letter' o 'solfege'.")
+        return
+    try:
+        _write_user_system(_safe_username_from_update(update), system)
+        context.user_data["awaiting_system"] = False
+        await update.message.reply_text(f"Sistema almacenado: {system}. Usa /play para continuar practicando.")
+    except Exception as e:
+        await update.message.reply_text(f"Error guardando la configuración: {e}")
 
 
 async def set_language_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Begin an interactive language-setting flow for the user."""
-    username = _safe_username_from_update(update)
+    """Set the language directly (/set_language es) or start the interactive flow."""
+    if context.args:
+        await _store_language(update, context, " ".join(context.args))
+        return
     context.user_data["awaiting_language"] = True
     await update.message.reply_text(
         "Por favor responde con el código de idioma que prefieres (ej.: 'es' o 'en')."
@@ -611,14 +1155,26 @@ async def set_language_command(update: Update, context: ContextTypes.DEFAULT_TYP
 
 
 async def set_system_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Begin an interactive notation-system-setting flow for the user."""
-    username = _safe_username_from_update(update)
+    """Set the notation system directly (/set_system solfege) or start the interactive flow."""
+    if context.args:
+        await _store_system(update, context, " ".join(context.args))
+        return
     context.user_data["awaiting_system"] = True
     await update.message.reply_text(
         "Indica el sistema de notación que prefieres: 'letter' (C D E ...) o 'solfege' (do re mi ...)."
     )
 
 
+async def _recent_session_files(username: str, n: int) -> list[Path]:
+    """Newest ``n`` session CSVs of ``username``, listed on _SESSION_IO_POOL."""
+    # usuario sin historial: ni siquiera hace falta pasar por el pool
+    if not _user_sessions_dir(username).is_dir():
+        return []
+    return await asyncio.get_running_loop().run_in_executor(
+        _SESSION_IO_POOL, _list_user_sessions, username, n
+    )
+
+
 async def old_games_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Quick list of recent saved games (convenience replacement for quick-history)."""
     args = context.args if hasattr(context, 'args') else []
@@ -629,8 +1185,7 @@ async def old_games_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             n = 5
 
-    username = _safe_username_from_update(update)
-    files = _list_user_sessions(username)[:n]
+    files = await _recent_session_files(_safe_username_from_update(update), n)
     if not files:
         await update.message.reply_text("No hay sesiones guardadas para este usuario.")
         return
@@ -644,7 +1199,8 @@ async def old_games_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def free_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Enter free mode: no timing, no saving."""
     context.user_data["mode"] = "free"
-    context.user_data.pop("session_records", None)
+    context.user_data.pop("session_count", None)
+    context.user_data.pop("session_path", None)
     context.user_data["invalid_count"] = 0
     await update.message.reply_text("Modo libre activado. Te mostraré notas sin medir tiempos ni guardar resultados.")
     await send_new_note(update, context)
@@ -653,9 +1209,11 @@ async def free_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def time_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Enter timed mode: start a new timed session."""
     context.user_data["mode"] = "time"
-    context.user_data["session_records"] = []
+    # los intentos se escriben al responder; aquí solo se cuentan los guardados
+    context.user_data["session_count"] = 0
+    context.user_data["session_path"] = _new_session_path(_safe_username_from_update(update))
     context.user_data["invalid_count"] = 0
-    await update.message.reply_text("Modo temporizado activado. Tus tiempos y aciertos se guardarán en la carpeta de sesiones al finalizar (/stop).")
+    await update.message.reply_text("Modo temporizado activado. Tus tiempos y aciertos se guardan en la carpeta de sesiones a medida que respondes (/stop para terminar).")
     await send_new_note(update, context)
 
 
@@ -665,142 +1223,159 @@ async def stop_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("No hay una sesión temporizada en curso.")
         return
 
-    records = context.user_data.get("session_records", [])
-    username = _safe_username_from_update(update)
-    if not records:
+    if not context.user_data.get("session_count"):
         await update.message.reply_text("No hay datos de sesión para guardar.")
     else:
-        try:
-            p = _save_session_records(username, records)
-            await update.message.reply_text(f"Sesión guardada en: {p}")
-        except Exception as e:
-            await update.message.reply_text(f"Error guardando la sesión: {e}")
+        # los intentos ya se escribieron al responder
+        await update.message.reply_text(f"Sesión guardada en: {context.user_data.get('session_path')}")
 
-    # Clear session
-    context.user_data.pop("session_records", None)
-    context.user_data.pop("mode", None)
-    context.user_data.pop("current_note", None)
-    context.user_data["invalid_count"] = 0
+    _reset_session_state(context.user_data)
 
 
 async def settings_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(_menu_text_settings())
+    await update.message.reply_text(_MENU_SETTINGS)
 
 
 async def historial_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(_menu_text_historial())
-
-
-def _make_time_plot(records: list[dict]) -> BytesIO:
-    # aggregate across records
-    agg = _aggregate_records(records)
-    notes_order = ["C","D","E","F","G","A","B"]
-
-    # Build data for both clefs first so we can compute a common y-axis
-    data_by_clef = {}
-    global_max = 0.0
-    for clef in ["treble", "bass"]:
-        means = []
-        errs = []
-        labels = []
-        for note in notes_order:
-            data = agg.get(clef, {}).get(note)
-            if data:
-                m = float(data.get('avg_time_correct', 0.0))
-                e = float(data.get('std_time_correct', 0.0))
-            else:
-                m = 0.0
-                e = 0.0
-            means.append(m)
-            errs.append(e)
-            labels.append(note)
-            global_max = max(global_max, m + e)
-        data_by_clef[clef] = (means, errs, labels)
-
-    # Ensure a non-zero y range
-    if global_max <= 0:
-        global_max = 1.0
-
-    fig, axes = plt.subplots(2, 1, figsize=(8, 6), constrained_layout=True)
-    for i, clef in enumerate(["treble", "bass"]):
-        ax = axes[i]
-        means, errs, labels = data_by_clef[clef]
-        x = range(len(labels))
-        ax.bar(x, means, yerr=errs, capsize=5)
-        ax.set_xticks(x)
-        ax.set_xticklabels(labels)
-        ax.set_ylabel('Tiempo medio (s)')
-        ax.set_title('Tiempos por nota — ' + ("Clave de SOL" if clef=="treble" else "Clave de FA"))
-        ax.set_ylim(0, global_max * 1.10)
+    await update.message.reply_text(_MENU_HISTORIAL)
+
+
+# Las gráficas de estadísticas se dibujan sobre Figure + FigureCanvasAgg, sin
+# pasar por pyplot: no se registran en el estado global (Gcf), se pueden
+# generar desde cualquier hilo y no dependen del backend interactivo que use
+# el modo local para sus ventanas.
+#
+# Cada tipo de gráfica reutiliza una única figura, creada y configurada
+# (ticks, etiquetas, títulos) la primera vez que se pide. En cada llamada solo
+# se actualizan la altura de las barras y sus barras de error, lo que evita
+# reconstruir figura, canvas, ejes y artistas en cada petición. El lock de cada
+# figura serializa a quienes la dibujan desde distintos hilos.
+
+_PLOT_X = np.arange(len(_NOTES_ORDER))
+_PLOT_FIGURES: dict[str, tuple] = {}
+_PLOT_FIGURES_LOCK = threading.Lock()
+
+# tipo de gráfica -> (etiqueta del eje y, prefijo del título, límite y fijo)
+_PLOT_AXES = {
+    "tiempos": ('Tiempo medio (s)', 'Tiempos por nota — ', None),
+    "aciertos": ('Aciertos (%)', 'Tasa de aciertos por nota — ', (0, 100)),
+}
 
-    buf = BytesIO()
-    fig.savefig(buf, format='png', bbox_inches='tight')
-    plt.close(fig)
-    buf.seek(0)
-    return buf
 
+def _clef_title(clef: str) -> str:
+    return "Clave de SOL" if clef == "treble" else "Clave de FA"
 
-def _make_success_plot(records: list[dict]) -> BytesIO:
-    agg = _aggregate_records(records)
-    notes_order = ["C","D","E","F","G","A","B"]
-
-    fig, axes = plt.subplots(2, 1, figsize=(8, 6), constrained_layout=True)
-    for i, clef in enumerate(["treble", "bass"]):
-        ax = axes[i]
-        means = []
-        errs = []
-        labels = []
-        for note in notes_order:
-            data = agg.get(clef, {}).get(note)
-            if data:
-                means.append(data.get('success_rate', 0.0))
-                errs.append(data.get('success_se', 0.0))
-                labels.append(note)
-            else:
-                means.append(0.0)
-                errs.append(0.0)
-                labels.append(note)
-
-        x = range(len(labels))
-        ax.bar(x, means, yerr=errs, capsize=5)
-        ax.set_xticks(x)
-        ax.set_xticklabels(labels)
-        ax.set_ylim(0, 100)
-        ax.set_ylabel('Aciertos (%)')
-        ax.set_title('Tasa de aciertos por nota — ' + ("Clave de SOL" if clef=="treble" else "Clave de FA"))
 
+def _plot_figure(kind: str):
+    """Devuelve (fig, axes, bars, lock) de la figura reutilizable para ``kind``.
+
+    ``bars`` tiene un BarContainer (con sus barras de error) por clave.
+    """
+    with _PLOT_FIGURES_LOCK:
+        slot = _PLOT_FIGURES.get(kind)
+        if slot is None:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            from matplotlib.figure import Figure
+
+            fig = Figure(figsize=(8, 6), layout="constrained")
+            FigureCanvasAgg(fig)
+            axes = fig.subplots(2, 1)
+            ylabel, title, ylim = _PLOT_AXES[kind]
+            zeros = np.zeros(len(_NOTES_ORDER))
+            bars = []
+            for ax, clef in zip(axes, _CLEFS_ORDER):
+                bars.append(ax.bar(_PLOT_X, zeros, yerr=zeros, capsize=5))
+                ax.set_xticks(_PLOT_X)
+                ax.set_xticklabels(_NOTES_ORDER)
+                ax.set_ylabel(ylabel)
+                ax.set_title(title + _clef_title(clef))
+                if ylim is not None:
+                    ax.set_ylim(*ylim)
+            slot = _PLOT_FIGURES[kind] = (fig, axes, bars, threading.Lock())
+    return slot
+
+
+def _update_bars(bars, means: np.ndarray, errs: np.ndarray) -> None:
+    """Set the heights and error bars of a BarContainer created by ax.bar(yerr=...)."""
+    for rect, height in zip(bars.patches, means):
+        rect.set_height(height)
+    _, (low_caps, high_caps), (err_lines,) = bars.errorbar.lines
+    low, high = means - errs, means + errs
+    err_lines.set_segments(np.stack([
+        np.column_stack([_PLOT_X, low]),
+        np.column_stack([_PLOT_X, high]),
+    ], axis=1))
+    low_caps.set_ydata(low)
+    high_caps.set_ydata(high)
+
+
+# Las gráficas se codifican una sola vez por combinación de sesiones (ver
+# _render_stats_plot), así que aquí sí compensa comprimir: 80 dpi y PNG
+# optimizado dejan cada gráfica en ~20 KB en vez de ~35 KB para send_photo.
+_PLOT_DPI = 80
+_PLOT_PNG = {"optimize": True}
+
+
+def _figure_png(fig) -> BytesIO:
     buf = BytesIO()
-    fig.savefig(buf, format='png', bbox_inches='tight')
-    plt.close(fig)
+    fig.savefig(buf, format='png', dpi=_PLOT_DPI, bbox_inches='tight', pil_kwargs=_PLOT_PNG)
     buf.seek(0)
     return buf
 
 
-async def tiempos_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # optional arg: number of last sessions to include
-    args = context.args if hasattr(context, 'args') else []
-    n = 1
-    if args:
-        try:
-            n = max(1, int(args[0]))
-        except Exception:
-            n = 1
+def _make_time_plot(agg: dict) -> BytesIO:
+    means, errs = agg['avg_time_correct'], agg['std_time_correct']
+    # Common y-axis for both clefs; ensure a non-zero range
+    global_max = float((means + errs).max()) or 1.0
 
-    username = _safe_username_from_update(update)
-    files = _list_user_sessions(username)[:n]
-    if not files:
-        await update.message.reply_text("No hay sesiones para generar graficas.")
-        return
+    fig, axes, bars, lock = _plot_figure("tiempos")
+    with lock:
+        for i, ax in enumerate(axes):
+            _update_bars(bars[i], means[i], errs[i])
+            ax.set_ylim(0, global_max * 1.10)
+        return _figure_png(fig)
 
-    combined = []
-    for p in files:
-        combined.extend(_read_session_csv(p))
 
-    buf = _make_time_plot(combined)
-    await update.effective_chat.send_photo(photo=buf)
+def _make_success_plot(agg: dict) -> BytesIO:
+    means, errs = agg['success_rate'], agg['success_se']
 
+    fig, axes, bars, lock = _plot_figure("aciertos")
+    with lock:
+        for i in range(len(axes)):
+            _update_bars(bars[i], means[i], errs[i])
+        return _figure_png(fig)
 
-async def aciertos_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+
+_PLOT_BUILDERS = {"tiempos": _make_time_plot, "aciertos": _make_success_plot}
+
+
+def _session_files_key(files: list[Path]) -> tuple[tuple[str, tuple[int, int]], ...]:
+    """Clave de caché: (ruta, (st_mtime_ns, st_size)) de cada CSV de sesión."""
+    return tuple((str(p), _file_version(p.stat())) for p in files)
+
+
+@functools.lru_cache(maxsize=64)
+def _render_stats_plot(kind: str, files_key: tuple[tuple[str, tuple[int, int]], ...]) -> bytes | None:
+    """PNG de la gráfica ``kind`` para las sesiones de ``files_key``.
+
+    Devuelve None si las sesiones no contienen registros. Como la clave
+    incluye el mtime y el tamaño de cada fichero, una sesión que sigue
+    creciendo produce una clave nueva y la gráfica se vuelve a generar.
+    """
+    agg = _aggregate_records_streaming(Path(p) for p, _ in files_key)
+    if not agg["attempts"].any():
+        return None
+    return _PLOT_BUILDERS[kind](agg).getvalue()
+
+
+def _stats_plot(kind: str, files: list[Path]) -> BytesIO | None:
+    png = _render_stats_plot(kind, _session_files_key(files))
+    return BytesIO(png) if png is not None else None
+
+
+async def _stats_command(kind: str, update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Send the ``kind`` plot ("tiempos" or "aciertos") of the last n sessions."""
+    # optional arg: number of last sessions to include
     args = context.args if hasattr(context, 'args') else []
     n = 1
     if args:
@@ -809,23 +1384,27 @@ async def aciertos_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             n = 1
 
-    username = _safe_username_from_update(update)
-    files = _list_user_sessions(username)[:n]
+    files = await _recent_session_files(_safe_username_from_update(update), n)
     if not files:
         await update.message.reply_text("No hay sesiones para generar graficas.")
         return
 
-    combined = []
-    for p in files:
-        combined.extend(_read_session_csv(p))
-
-    if not combined:
-        await update.message.reply_text("No hay datos de aciertos para mostrar.")
+    buf = await asyncio.get_running_loop().run_in_executor(_PLOT_POOL, _stats_plot, kind, files)
+    if buf is None:
+        await update.message.reply_text(f"No hay datos de {kind} para mostrar.")
         return
 
-    buf = _make_success_plot(combined)
     await update.effective_chat.send_photo(photo=buf)
 
+
+async def tiempos_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _stats_command("tiempos", update, context)
+
+
+async def aciertos_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _stats_command("aciertos", update, context)
+
+
 async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_text = update.message.text
     current = context.user_data.get("current_note")
@@ -840,49 +1419,14 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    # If we're awaiting a language reply, accept it here and save
+    # Interactive fallback of /set_language and /set_system (and of the
+    # first-time language prompt above): the reply is the chosen value
     if context.user_data.get("awaiting_language") and not current:
-        lang_try = (user_text or "").strip().lower()
-        if not lang_try:
-            await update.message.reply_text("No se recibió un idioma válido. Intenta de nuevo: 'es' o 'en'.")
-            return
-        # normalize common names
-        if lang_try.startswith("es") or lang_try.startswith("span"):
-            lang = "es"
-        elif lang_try.startswith("en") or lang_try.startswith("eng"):
-            lang = "en"
-        else:
-            # accept raw two-letter codes
-            lang = lang_try[:2]
-
-        try:
-            _write_user_language(username, lang)
-            context.user_data["awaiting_language"] = False
-            await update.message.reply_text(f"Idioma almacenado: {lang}. Puedes usar /help para ver opciones.")
-        except Exception as e:
-            await update.message.reply_text(f"Error guardando la configuración: {e}")
+        await _store_language(update, context, user_text)
         return
 
     if context.user_data.get("awaiting_system") and not current:
-        sys_try = (user_text or "").strip().lower()
-        if not sys_try:
-            await update.message.reply_text("No se recibió un sistema válido. Escribe 'letter' o 'solfege'.")
-            return
-
-        if sys_try.startswith("let") or sys_try in ("letter", "letters", "abc"):
-            system = "letter"
-        elif sys_try.startswith("sol") or sys_try in ("solfege", "solfeo", "do", "doremi"):
-            system = "solfege"
-        else:
-            await update.message.reply_text("Opción no reconocida. Escribe 'letter' o 'solfege'.")
-            return
-
-        try:
-            _write_user_system(username, system)
-            context.user_data["awaiting_system"] = False
-            await update.message.reply_text(f"Sistema almacenado: {system}. Usa /play para continuar practicando.")
-        except Exception as e:
-            await update.message.reply_text(f"Error guardando la configuración: {e}")
+        await _store_system(update, context, user_text)
         return
 
     # If there's no active note, still count unrecognized answers so that
@@ -890,19 +1434,9 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not current:
         # Intercept first-layer commands like play / historial / help / start
         cmd = (user_text or "").strip().lstrip('/').lower()
-        if cmd in ("play",):
-            # second-layer: show play modes
-            await update.message.reply_text(_menu_text_play())
-            return
-        if cmd in ("historial",):
-            await update.message.reply_text(_menu_text_historial())
-            return
-        if cmd in ("help", "start"):
-            await help_command(update, context)
-            return
-        if cmd in ("settings",):
-            # Show settings quick menu (language & notation system)
-            await update.message.reply_text(_menu_text_settings())
+        menu = _CMD_DISPATCH.get(cmd)
+        if menu is not None:
+            await update.message.reply_text(menu)
             return
 
         user_letter_try = normalize_answer(user_text)
@@ -937,34 +1471,23 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if context.user_data.get("mode") == "time":
         last_ts = context.user_data.get("last_shown_ts")
         tsec = None
-        if last_ts:
-            tsec = max(0.0, time.time() - last_ts)
+        if last_ts is not None:
+            tsec = (time.monotonic_ns() - last_ts) / 1e9
         # If the user took longer than 60 seconds to answer, stop the timed
         # session automatically and save previous records (do not record
         # this last slow attempt).
         if tsec is not None and tsec > 60:
-            records = context.user_data.get("session_records", [])
-            username = _safe_username_from_update(update)
-            if records:
-                try:
-                    p = _save_session_records(username, records)
-                    await update.message.reply_text(f"Sesión guardada en: {p}")
-                except Exception as e:
-                    await update.message.reply_text(f"Error guardando la sesión: {e}")
+            if context.user_data.get("session_count"):
+                await update.message.reply_text(f"Sesión guardada en: {context.user_data.get('session_path')}")
             else:
                 await update.message.reply_text("Sesión temporizada terminada por inactividad (más de 60s) — no hay datos para guardar.")
 
-            # Clear session state
-            context.user_data.pop("session_records", None)
-            context.user_data.pop("mode", None)
-            context.user_data.pop("current_note", None)
-            context.user_data.pop("last_shown_ts", None)
-            context.user_data["invalid_count"] = 0
+            _reset_session_state(context.user_data)
             await help_command(update, context)
             return
 
         rec = {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": time.time(),  # epoch seconds; formatted when written
             "clef": current.get("clef"),
             "letter": current.get("letter"),
             "solfege": current.get("solfege"),
@@ -980,23 +1503,12 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if invalid_count >= 2:
             # Stop the session: if we were in timed mode, save previous records
             if context.user_data.get("mode") == "time":
-                records = context.user_data.get("session_records", [])
-                username = _safe_username_from_update(update)
-                if records:
-                    try:
-                        p = _save_session_records(username, records)
-                        await update.message.reply_text(f"Sesión guardada en: {p}")
-                    except Exception as e:
-                        await update.message.reply_text(f"Error guardando la sesión: {e}")
+                if context.user_data.get("session_count"):
+                    await update.message.reply_text(f"Sesión guardada en: {context.user_data.get('session_path')}")
                 else:
                     await update.message.reply_text("Sesión temporizada terminada — no hay datos para guardar.")
 
-            context.user_data.pop("current_note", None)
-            context.user_data["invalid_count"] = 0
-            # clear timed session state
-            context.user_data.pop("session_records", None)
-            context.user_data.pop("mode", None)
-            context.user_data.pop("last_shown_ts", None)
+            _reset_session_state(context.user_data)
             await update.message.reply_text(
                 "Demasiadas respuestas no reconocidas. Reiniciando la sesión."
             )
@@ -1025,11 +1537,17 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # If timed mode, finalize and store the record
     if context.user_data.get("mode") == "time":
+        rec["correct"] = correct
+        session_count = context.user_data.get("session_count", 0)
         try:
-            rec["correct"] = correct
-            context.user_data.setdefault("session_records", []).append(rec)
-        except Exception:
-            pass
+            session_path = await asyncio.get_running_loop().run_in_executor(
+                _SESSION_IO_POOL, _append_session_records, context.user_data["session_path"], [rec], not session_count
+            )
+        except Exception as e:
+            await update.message.reply_text(f"Error guardando la sesión: {e}")
+        else:
+            context.user_data["session_path"] = session_path
+            context.user_data["session_count"] = session_count + 1
 
     await update.message.reply_text(reply)
     await send_new_note(update, context)
@@ -1039,13 +1557,84 @@ async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # FUNCIÓN PRINCIPAL
 # =========================================================
 
-def main(token: str | None = None):
+# Actualizaciones que se atienden a la vez. Las de un mismo usuario se
+# procesan en orden (comparten user_data y la nota en curso); las de usuarios
+# distintos avanzan en paralelo mientras otra espera a Telegram o al disco.
+_MAX_CONCURRENT_UPDATES = 64
+
+# Segundos que Telegram retiene cada getUpdates cuando no hay mensajes
+_POLL_TIMEOUT = 30
+
+# Dirección y puerto por defecto del servidor del webhook (--listen/--port)
+_WEBHOOK_LISTEN = "0.0.0.0"
+_WEBHOOK_PORT = 8443
+
+
+def _per_user_update_processor(max_concurrent_updates: int):
+    """Build an update processor that runs updates concurrently across users
+    but strictly one at a time for each user."""
+    from telegram.ext import BaseUpdateProcessor
+
+    class PerUserUpdateProcessor(BaseUpdateProcessor):
+        def __init__(self, max_concurrent_updates: int):
+            super().__init__(max_concurrent_updates)
+            # user/chat id -> lock; a lock disappears once nobody is using it
+            self._locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+        async def do_process_update(self, update, coroutine) -> None:
+            user = getattr(update, "effective_user", None)
+            chat = getattr(update, "effective_chat", None)
+            key = user.id if user is not None else chat.id if chat is not None else None
+            if key is None:
+                await coroutine
+                return
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = asyncio.Lock()
+            async with lock:
+                await coroutine
+
+        async def initialize(self) -> None:
+            pass
+
+        async def shutdown(self) -> None:
+            pass
+
+    return PerUserUpdateProcessor(max_concurrent_updates)
+
+
+def main(
+    token: str | None = None,
+    webhook_url: str | None = None,
+    listen: str = _WEBHOOK_LISTEN,
+    port: int = _WEBHOOK_PORT,
+    cert: str | None = None,
+    key: str | None = None,
+):
     """Start Telegram bot using provided token. If token is None, fall back to
     an embedded TELEGRAM_TOKEN if present.
+
+    By default updates are fetched with long polling. With ``webhook_url``
+    (public https base URL that reaches ``listen:port``) Telegram pushes them
+    to a webhook instead; this needs ``python-telegram-bot[webhooks]``.
+    Telegram only delivers webhooks over HTTPS: either pass ``cert``/``key``
+    (PEM files) so the server speaks TLS itself, or put a TLS-terminating
+    reverse proxy in front of it.
     """
     script_token = globals().get("TELEGRAM_TOKEN")
     use_token = token or script_token
-    app = ApplicationBuilder().token(use_token).build()
+
+    from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, filters
+
+    # Renderizar todas las notas una sola vez antes de aceptar mensajes
+    warm_note_image_cache()
+
+    app = (
+        ApplicationBuilder()
+        .token(use_token)
+        .concurrent_updates(_per_user_update_processor(_MAX_CONCURRENT_UPDATES))
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("help", help_command))
@@ -1064,19 +1653,49 @@ def main(token: str | None = None):
     # Cualquier texto que no sea comando se interpreta como respuesta a la nota
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_answer))
 
-    app.run_polling()
+    if webhook_url:
+        # La ruta del webhook se deriva del token (sin exponerlo en URLs ni en
+        # logs): solo Telegram, que conoce la URL completa, puede llamarla.
+        url_path = hashlib.sha256(use_token.encode("utf-8")).hexdigest()
+        app.run_webhook(
+            listen=listen,
+            port=port,
+            url_path=url_path,
+            webhook_url=f"{webhook_url.rstrip('/')}/{url_path}",
+            # Telegram repite este secreto en cada POST (cabecera
+            # X-Telegram-Bot-Api-Secret-Token); las peticiones sin él se
+            # rechazan. El webhook se registra de nuevo en cada arranque, así
+            # que basta con uno aleatorio por proceso.
+            secret_token=secrets.token_hex(32),
+            cert=cert,
+            key=key,
+            bootstrap_retries=-1,
+            allowed_updates=["message"],
+        )
+        return
+
+    # Long polling: Telegram mantiene abierta cada petición getUpdates hasta
+    # 30 s y responde en cuanto llega un mensaje, así que con poco tráfico hay
+    # muy pocas peticiones y ninguna espera entre una y otra. Solo se piden
+    # mensajes, que es lo único que atienden los handlers.
+    app.run_polling(
+        poll_interval=0.0,
+        timeout=_POLL_TIMEOUT,
+        bootstrap_retries=-1,
+        allowed_updates=["message"],
+    )
+
+
+# (clef, staff_index, NoteInfo) de cada nota que se puede preguntar
+_VALID_NOTES = tuple(
+    (clef, staff_index, get_note_info(clef, staff_index))
+    for clef, staff_index in _ALL_NOTES
+)
 
 
 def choose_random_valid_note():
     """Choose a random clef and staff_index that is valid for the note tables."""
-    while True:
-        clef = random.choice(["treble", "bass"])
-        staff_index = random.randint(-2, 12)
-        try:
-            note_info = get_note_info(clef, staff_index)
-            return clef, staff_index, note_info
-        except ValueError:
-            continue
+    return random.choice(_VALID_NOTES)
 
 
 def local_run(rounds: int | None = None):
@@ -1087,21 +1706,16 @@ def local_run(rounds: int | None = None):
     print("Modo local de Solfeo — escribe 'q' para salir en cualquier momento.")
     print("Escribe 'play', 'historial' o 'settings' para empezar — también puedes usar /play, /historial o /settings en Telegram.")
 
+    # computed once: every command below uses this same name
     username = "local_" + getpass.getuser()
     # Ensure language is configured for local user; ask and store if missing
     lang = _read_user_language(username)
     if not lang:
         print("No se ha configurado el idioma para el modo local.")
         while True:
-            choice = input("Introduce el código de idioma que prefieres (ej. 'es' o 'en'): ").strip().lower()
-            if not choice:
+            lang = _parse_language(_input_with_gui("Introduce el código de idioma que prefieres (ej. 'es' o 'en'): "))
+            if not lang:
                 continue
-            if choice.startswith('es') or choice.startswith('span'):
-                lang = 'es'
-            elif choice.startswith('en') or choice.startswith('eng'):
-                lang = 'en'
-            else:
-                lang = choice[:2]
             try:
                 _write_user_language(username, lang)
                 print(f"Idioma almacenado: {lang}")
@@ -1111,321 +1725,284 @@ def local_run(rounds: int | None = None):
                 continue
 
     played = 0
-    invalid_count = 0
-    mode = 'free'
-    session_records = []
-    current_note = None
-    last_shown_ts = None
+    # Estado de la partida local, compartido por los comandos de la tabla
+    state = {
+        'mode': 'free',
+        # en modo 'time' cada intento se añade al CSV de la sesión al
+        # responder; aquí solo se cuentan
+        'session_path': None,
+        'session_count': 0,
+        'invalid_count': 0,
+        'current_note': None,
+        'last_shown_ts': None,
+    }
+
+    # pyplot solo se usa para mostrar imágenes ya renderizadas (las notas con
+    # Pillow, las gráficas con Agg). Una ventana para las notas y otra para
+    # las estadísticas: cada una se crea la primera vez (o si el usuario la
+    # cierra) y después solo se le cambia la imagen.
+    note_view = {}
+    stats_view = {}
+
+    def show_in_window(view, img, figsize, title):
+        # pyplot (y el backend GUI) se importa al abrir la primera ventana
+        import matplotlib.pyplot as plt
+
+        fig = view.get("fig")
+        if fig is None or not plt.fignum_exists(fig.number):
+            fig = plt.figure(figsize=figsize)
+            ax = fig.add_subplot(111)
+            ax.axis("off")
+            try:
+                fig.canvas.manager.set_window_title(title)
+            except Exception:
+                pass
+            view["fig"] = fig
+            view["image"] = ax.imshow(img)
+            plt.show(block=False)
+            # solo una ventana nueva le quita el foco a la consola
+            restore_console_focus()
+        else:
+            image = view["image"]
+            image.set_data(img)
+            height, width = img.shape[:2]
+            image.set_extent((-0.5, width - 0.5, height - 0.5, -0.5))
+            fig.canvas.draw_idle()
+            fig.canvas.flush_events()
 
     def show_note_and_display(clef, staff_index, note_info):
-        buf = generate_note_image(clef, staff_index)
-        img = plt.imread(buf, format="png")
-        fig = plt.figure(figsize=(6, 3))
-        ax = fig.add_subplot(111)
-        ax.imshow(img)
-        ax.axis("off")
-        try:
-            fig.canvas.manager.set_window_title("Solfeo — Adivina la nota")
-        except Exception:
-            pass
-        plt.show(block=False)
-        restore_console_focus()
-        return fig
+        show_in_window(note_view, _note_array(clef, staff_index), (6, 3), "Solfeo — Adivina la nota")
 
-    try:
-        while True:
-            # If there's no active note, wait for a command to start one
-            if current_note is None:
-                cmd_input = input("local> ").strip()
-                if not cmd_input:
-                    continue
-                # allow slash or plain commands
-                raw = cmd_input.lstrip()
-                if raw.lower() in ("q", "quit", "exit"):
-                    print("Saliendo. Hasta luego.")
-                    return
+    def ask(prompt):
+        # Mientras se espera la respuesta las ventanas siguen atendiendo eventos
+        for view in (note_view, stats_view):
+            fig = view.get("fig")
+            if fig is None:
+                continue
+            import matplotlib.pyplot as plt
+
+            if plt.fignum_exists(fig.number):
+                return _input_with_gui(prompt, fig)
+        return _input_with_gui(prompt)
+
+    def show_next_note(state):
+        # la nota activa es la propia entrada (clef, staff_index, NoteInfo)
+        # de _VALID_NOTES: no se construye nada por ronda
+        note = choose_random_valid_note()
+        show_note_and_display(*note)
+        state['current_note'] = note
+        state['last_shown_ts'] = time.monotonic_ns()
+
+    def start_mode(state, mode, message):
+        state['mode'] = mode
+        state['session_path'] = _new_session_path(username) if mode == 'time' else None
+        state['session_count'] = 0
+        state['invalid_count'] = 0
+        print(message)
+        # start immediately: choose and show first note
+        show_next_note(state)
+
+    # Comandos del modo local, con o sin nota activa: cada uno recibe el
+    # estado y los argumentos que siguen al nombre del comando
+    def cmd_help(state, args):
+        print()
+        if state['current_note'] is None:
+            # /start behaves like help: show top-level menu
+            print(_MENU_MAIN)
+            return
+        print(
+            "Instrucciones:\n\n"
+            "• Usa 'play' para comenzar una práctica (elige 'free' o 'time').\n"
+            "• Cada imagen muestra una nota en clave de SOL o de FA.\n"
+            "• Responde con el nombre de la nota (do, re, mi, fa, sol, la, si) "
+            "o con letras (C, D, E, F, G, A, B).\n"
+            "• No es necesario indicar la octava.\n"
+        )
 
-                c = raw.lstrip('/')
-                parts = c.split()
-                cmd = parts[0].lower()
-                args = parts[1:]
+    def cmd_menu(menu):
+        return lambda state, args: print(menu)
 
-                if cmd in ("help", "start"):
-                    # /start behaves like help: show top-level menu
-                    print()
-                    print(_menu_text_main())
-                    continue
-                if cmd == 'play':
-                    print(_menu_text_play())
-                    continue
+    def cmd_free(state, args):
+        start_mode(state, 'free', "Modo libre activado. Mostrando primera nota...")
 
-                if cmd == 'free':
-                    mode = 'free'
-                    session_records = []
-                    invalid_count = 0
-                    print("Modo libre activado. Mostrando primera nota...")
-                    # start immediately: choose and show first note
-                    clef, staff_index, note_info = choose_random_valid_note()
-                    fig = show_note_and_display(clef, staff_index, note_info)
-                    current_note = {
-                        'clef': clef,
-                        'staff_index': staff_index,
-                        'pitch': note_info.get('pitch'),
-                        'letter': note_info.get('letter'),
-                        'solfege': note_info.get('solfege'),
-                        'fig': fig,
-                    }
-                    last_shown_ts = time.time()
-                    continue
+    def cmd_time(state, args):
+        start_mode(
+            state,
+            'time',
+            "Modo temporizado activado. Tus tiempos y aciertos se guardan a medida que respondes ('stop' para terminar). Mostrando primera nota...",
+        )
 
-                if cmd == 'time':
-                    mode = 'time'
-                    session_records = []
-                    invalid_count = 0
-                    print("Modo temporizado activado. Tus tiempos y aciertos se guardarán al usar 'stop'. Mostrando primera nota...")
-                    # start immediately: choose and show first note
-                    clef, staff_index, note_info = choose_random_valid_note()
-                    fig = show_note_and_display(clef, staff_index, note_info)
-                    current_note = {
-                        'clef': clef,
-                        'staff_index': staff_index,
-                        'pitch': note_info.get('pitch'),
-                        'letter': note_info.get('letter'),
-                        'solfege': note_info.get('solfege'),
-                        'fig': fig,
-                    }
-                    last_shown_ts = time.time()
-                    continue
+    def end_timed_session(state, no_data_message):
+        # los intentos ya se escribieron al responder
+        if state['session_count']:
+            print(f"Sesión guardada en: {state['session_path']}")
+        else:
+            print(no_data_message)
+        state['mode'] = 'free'
+        state['session_path'] = None
+        state['session_count'] = 0
+        state['invalid_count'] = 0
+
+    def cmd_stop(state, args):
+        # stop always leaves the current note, in either mode
+        state['current_note'] = None
+        if state['mode'] != 'time':
+            print("No hay una sesión temporizada en curso.")
+            return
+        end_timed_session(state, "No hay datos de sesión para guardar.")
 
-                if cmd == 'stop':
-                    if mode != 'time':
-                        print("No hay una sesión temporizada en curso.")
-                        continue
-                    username = "local_" + getpass.getuser()
-                    try:
-                        p = _save_session_records(username, session_records)
-                        print(f"Sesión guardada en: {p}")
-                    except Exception as e:
-                        print(f"Error guardando la sesión: {e}")
-                    mode = 'free'
-                    session_records = []
-                    invalid_count = 0
-                    continue
+    def cmd_set_language(state, args):
+        # como en Telegram, el valor puede ir tras el comando o pedirse aparte
+        lang = _parse_language(" ".join(args) or ask("Introduce el código de idioma que prefieres (ej. 'es' o 'en'): "))
+        if not lang:
+            print("No se recibió el idioma. Cancelado.")
+            return
+        if lang not in ('es', 'en'):
+            print("Opción no válida. Usa 'es' o 'en'.")
+            return
+        try:
+            _write_user_language(username, lang)
+            print(f"Idioma almacenado: {lang}")
+        except Exception as e:
+            print(f"Error guardando la configuración: {e}")
 
-                if cmd == 'historial':
-                    print(_menu_text_historial())
-                    continue
+    def cmd_set_system(state, args):
+        sys_choice = " ".join(args) or ask("¿Qué sistema de notación prefieres? ('letter' o 'solfege'): ")
+        if not sys_choice.strip():
+            print("No se recibió sistema. Cancelado.")
+            return
+        system = _parse_system(sys_choice)
+        if system is None:
+            print("Opción no válida. Responde 'letter' o 'solfege'.")
+            return
+        try:
+            _write_user_system(username, system)
+            print(f"Sistema almacenado: {system}")
+        except Exception as e:
+            print(f"Error guardando la configuración: {e}")
 
-                if cmd == 'settings':
-                    # Show settings options for local user
-                    print(_menu_text_settings())
-                    continue
+    def count_arg(args, default):
+        if args:
+            try:
+                return max(1, int(args[0]))
+            except Exception:
+                pass
+        return default
 
-                if cmd == 'set_language':
-                    try:
-                        plt.close(current_note.get('fig'))
-                    except Exception:
-                        pass
-                    new = input("Introduce el código de idioma que prefieres (ej. 'es' o 'en'): ").strip().lower()
-                    if not new:
-                        print("No se recibió el idioma. Cancelado.")
-                        continue
-                    if new.startswith('es') or new.startswith('span'):
-                        lang = 'es'
-                    elif new.startswith('en') or new.startswith('eng'):
-                        lang = 'en'
-                    else:
-                        print("Opción no válida. Usa 'es' o 'en'.")
-                        continue
-                    try:
-                        _write_user_language(username, lang)
-                        print(f"Idioma almacenado: {lang}")
-                    except Exception as e:
-                        print(f"Error guardando la configuración: {e}")
-                    continue
+    def cmd_old_games(state, args):
+        files = _list_user_sessions(username, count_arg(args, 5))
+        if not files:
+            print("No hay sesiones guardadas para este usuario.")
+        else:
+            print(f"Últimas {len(files)} sesiones:")
+            for p in files:
+                print(p.name)
+
+    def cmd_stats(kind):
+        # /tiempos y /aciertos solo se diferencian en la gráfica que generan
+        def show_stats(state, args):
+            files = _list_user_sessions(username, count_arg(args, 1))
+            bufp = _stats_plot(kind, files)
+            if bufp is None:
+                print("No hay datos para generar graficas.")
+                return
+            show_in_window(stats_view, _decode_png(bufp), (8, 6), "Solfeo — Estadísticas")
+        return show_stats
+
+    commands = {
+        'help': cmd_help,
+        'start': cmd_help,
+        'play': cmd_menu(_MENU_PLAY),
+        'historial': cmd_menu(_MENU_HISTORIAL),
+        'settings': cmd_menu(_MENU_SETTINGS),
+        'free': cmd_free,
+        'time': cmd_time,
+        'stop': cmd_stop,
+        'set_language': cmd_set_language,
+        'set_system': cmd_set_system,
+        'old_games': cmd_old_games,
+        'tiempos': cmd_stats('tiempos'),
+        'aciertos': cmd_stats('aciertos'),
+    }
 
-                if cmd == 'set_system':
-                    try:
-                        plt.close(current_note.get('fig'))
-                    except Exception:
-                        pass
-                    sys_choice = input("¿Qué sistema de notación prefieres? ('letter' o 'solfege'): ").strip().lower()
-                    if not sys_choice:
-                        print("No se recibió sistema. Cancelado.")
-                        continue
-                    if sys_choice.startswith('let') or sys_choice in ('abc', 'letters'):
-                        system = 'letter'
-                    elif sys_choice.startswith('sol') or sys_choice in ('solfege', 'solfeo'):
-                        system = 'solfege'
-                    else:
-                        print("Opción no válida. Responde 'letter' o 'solfege'.")
-                        continue
-                    try:
-                        _write_user_system(username, system)
-                        print(f"Sistema almacenado: {system}")
-                    except Exception as e:
-                        print(f"Error guardando la configuración: {e}")
-                    continue
+    # SIGTERM (p. ej. al cerrar la terminal o con kill) termina igual que Ctrl+C
+    def on_sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    previous_sigterm = signal.signal(signal.SIGTERM, on_sigterm)
+    # En una terminal stdout va por líneas y cada print es una escritura. Sin
+    # line buffering, todo lo impreso en una ronda sale de una vez con el
+    # flush que hace el siguiente prompt (_input_with_gui / input).
+    line_buffered = getattr(sys.stdout, "line_buffering", False)
+    if line_buffered:
+        sys.stdout.reconfigure(line_buffering=False)
+    try:
+        while True:
+            current_note = state['current_note']
+            if current_note is None:
+                # no active note: wait for a command to start one
+                user_text = ask("local> ")
+            else:
+                # current_note is a (clef, staff_index, NoteInfo) entry of _VALID_NOTES
+                user_text = ask("¿Qué nota es esta? (do/re/mi... o C/D/...) > ")
 
-                if cmd == 'old_games':
-                    username = "local_" + getpass.getuser()
-                    n = 5
-                    if args:
-                        try:
-                            n = max(1, int(args[0]))
-                        except Exception:
-                            n = 5
-                    files = _list_user_sessions(username)[:n]
-                    if not files:
-                        print("No hay sesiones guardadas para este usuario.")
-                    else:
-                        print(f"Últimas {len(files)} sesiones:")
-                        for p in files:
-                            print(p.name)
-                    continue
+            # allow slash or plain commands, with or without an active note
+            raw = user_text.strip()
+            if not raw:
+                continue
+            if raw.lower() in ("q", "quit", "exit"):
+                print("Saliendo. Hasta luego.")
+                return
 
-                if cmd == 'tiempos':
-                    username = "local_" + getpass.getuser()
-                    n = 1
-                    if args:
-                        try:
-                            n = max(1, int(args[0]))
-                        except Exception:
-                            n = 1
-                    files = _list_user_sessions(username)[:n]
-                    combined = []
-                    for p in files:
-                        combined.extend(_read_session_csv(p))
-                    if not combined:
-                        print("No hay datos para generar graficas.")
-                    else:
-                        bufp = _make_time_plot(combined)
-                        img2 = plt.imread(bufp, format='png')
-                        fig2 = plt.figure(figsize=(8,6))
-                        ax2 = fig2.add_subplot(111)
-                        ax2.imshow(img2)
-                        ax2.axis('off')
-                        plt.show(block=False)
-                        restore_console_focus()
-                    continue
+            parts = raw.lstrip('/').split()
+            handler = commands.get(parts[0].lower())
+            if handler is not None:
+                handler(state, parts[1:])
+                if state['mode'] == 'time' and state['current_note'] is current_note is not None:
+                    # La nota sigue en pantalla: el tiempo pasado en el
+                    # comando (menús, estadísticas, ajustes) no cuenta como
+                    # tiempo de respuesta ni para el límite de 60 s
+                    state['last_shown_ts'] = time.monotonic_ns()
+                continue
 
-                if cmd == 'aciertos':
-                    username = "local_" + getpass.getuser()
-                    n = 1
-                    if args:
-                        try:
-                            n = max(1, int(args[0]))
-                        except Exception:
-                            n = 1
-                    files = _list_user_sessions(username)[:n]
-                    combined = []
-                    for p in files:
-                        combined.extend(_read_session_csv(p))
-                    if not combined:
-                        print("No hay datos para generar graficas.")
-                    else:
-                        bufp = _make_success_plot(combined)
-                        img2 = plt.imread(bufp, format='png')
-                        fig2 = plt.figure(figsize=(8,6))
-                        ax2 = fig2.add_subplot(111)
-                        ax2.imshow(img2)
-                        ax2.axis('off')
-                        plt.show(block=False)
-                        restore_console_focus()
-                    continue
+            user_letter = normalize_answer(user_text)
 
+            if current_note is None:
                 # Unknown input when no note is active
-                user_letter_try = normalize_answer(cmd_input)
-                if user_letter_try is None:
-                    invalid_count += 1
-                    if invalid_count >= 2:
+                if user_letter is None:
+                    state['invalid_count'] += 1
+                    if state['invalid_count'] >= 2:
                         print("Demasiadas respuestas no reconocidas. Mostrando ayuda.")
                         print()
-                        print(_menu_text_main())
-                        invalid_count = 0
+                        print(_MENU_MAIN)
+                        state['invalid_count'] = 0
                     else:
                         print("Escribe '/start' para ver la ayuda.")
-                    continue
-
-            # If we reach here, current_note is active and we should prompt for a guess
-            # current_note is a dict with keys: clef, staff_index, pitch, letter, solfege, fig
-            prompt = "¿Qué nota es esta? (do/re/mi... o C/D/...) > "
-            user_text = input(prompt)
-
-            # Commands handling during an active note (allow slash or plain)
-            if not user_text.strip():
-                continue
-            raw = user_text.lstrip()
-            if raw.lower() in ("q", "quit", "exit"):
-                try:
-                    plt.close(current_note.get('fig'))
-                except Exception:
-                    pass
-                print("Saliendo. Hasta luego.")
-                return
-
-            if raw.startswith('/'):
-                c = raw.lstrip('/')
-            else:
-                c = raw
-            parts = c.split()
-            cmd = parts[0].lower()
-            args = parts[1:]
-
-            # handle the same commands as above when note is active
-            if cmd in ("help",):
-                print()
-                print(
-                    "Instrucciones:\n\n"
-                    "• Usa 'play' para comenzar una práctica (elige 'free' o 'time').\n"
-                    "• Cada imagen muestra una nota en clave de SOL o de FA.\n"
-                    "• Responde con el nombre de la nota (do, re, mi, fa, sol, la, si) "
-                    "o con letras (C, D, E, F, G, A, B).\n"
-                    "• No es necesario indicar la octava.\n"
-                )
-                continue
-
-            if cmd in ('free', 'time', 'stop', 'historial', 'tiempos', 'aciertos', 'settings'):
-                # Close current figure and delegate to the non-active-note logic by
-                # clearing current_note and letting the outer loop handle the command
-                try:
-                    plt.close(current_note.get('fig'))
-                except Exception:
-                    pass
-                # reset current_note so outer loop will accept the command
-                current_note = None
-                # push the command back into the input stream by simulating it
-                # we simply continue so the next loop iteration will prompt and the user
-                # can re-enter the command (simpler than programmatically re-invoking)
+                else:
+                    # It's a valid note text but there's no active note
+                    print("Escribe '/start' para ver la ayuda.")
                 continue
 
             # Regular guess handling
-            user_letter = normalize_answer(user_text)
-            expected_letter = current_note.get('letter')
-            pitch = current_note.get('pitch')
-            solfege = current_note.get('solfege')
+            clef, _, note_info = current_note
+            pitch, expected_letter, solfege = note_info.pitch, note_info.letter, note_info.solfege
 
             if user_letter is None:
-                invalid_count += 1
-                if invalid_count >= 2:
+                state['invalid_count'] += 1
+                if state['invalid_count'] >= 2:
                     print("Demasiadas respuestas no reconocidas. Reiniciando la sesión.")
                     print()
-                    print(_menu_text_main())
-                    # If timed session, save before exiting
-                    if mode == 'time' and session_records:
-                        username = "local_" + getpass.getuser()
-                        try:
-                            p = _save_session_records(username, session_records)
-                            print(f"Sesión guardada en: {p}")
-                        except Exception as e:
-                            print(f"Error guardando la sesión: {e}")
+                    print(_MENU_MAIN)
+                    # If timed session, report where it was saved before exiting
+                    if state['mode'] == 'time' and state['session_count']:
+                        print(f"Sesión guardada en: {state['session_path']}")
                     return
                 else:
                     print("No he podido interpretar la respuesta. Escribe por ejemplo: do, re, mi o C, D, E.")
                     continue
 
             # Reset invalid counter on any recognized attempt
-            invalid_count = 0
+            state['invalid_count'] = 0
             if user_letter == expected_letter:
                 print(f"Correcto. Es {pitch} ({solfege}).")
                 correct = True
@@ -1434,75 +2011,130 @@ def local_run(rounds: int | None = None):
                 correct = False
 
             # If in timed mode, record result with accurate timing
-            if mode == 'time':
-                try:
-                    tsec = max(0.0, time.time() - last_shown_ts)
-                except Exception:
-                    tsec = 0.0
+            if state['mode'] == 'time':
+                # last_shown_ts is always set together with current_note
+                tsec = (time.monotonic_ns() - state['last_shown_ts']) / 1e9
                 # If the user took longer than 60 seconds to answer,
                 # stop the timed session automatically and do NOT record
                 # this slow attempt.
-                if tsec is not None and tsec > 60:
-                    username = "local_" + getpass.getuser()
-                    if session_records:
-                        try:
-                            p = _save_session_records(username, session_records)
-                            print(f"Sesión guardada en: {p}")
-                        except Exception as e:
-                            print(f"Error guardando la sesión: {e}")
-                    else:
-                        print("Sesión temporizada terminada por inactividad (más de 60s) — no hay datos para guardar.")
-                    mode = 'free'
-                    session_records = []
-                    invalid_count = 0
-                    try:
-                        plt.close(current_note.get('fig'))
-                    except Exception:
-                        pass
-                    current_note = None
+                if tsec > 60:
+                    end_timed_session(
+                        state,
+                        "Sesión temporizada terminada por inactividad (más de 60s) — no hay datos para guardar.",
+                    )
+                    state['current_note'] = None
                     continue
 
-                session_records.append({
-                    'timestamp': datetime.now().isoformat(),
-                    'clef': current_note.get('clef'),
-                    'letter': current_note.get('letter'),
-                    'solfege': current_note.get('solfege'),
+                rec = {
+                    'timestamp': time.time(),
+                    'clef': clef,
+                    'letter': expected_letter,
+                    'solfege': solfege,
                     'correct': correct,
                     'time_seconds': tsec,
-                })
+                }
+                try:
+                    state['session_path'] = _append_session_records(
+                        state['session_path'], [rec], new=not state['session_count']
+                    )
+                    state['session_count'] += 1
+                except OSError as e:
+                    print(f"Error guardando el intento: {e}")
 
             played += 1
 
             # After answering, automatically show the next note
-            try:
-                plt.close(current_note.get('fig'))
-            except Exception:
-                pass
-            # choose and show next
-            clef, staff_index, note_info = choose_random_valid_note()
-            fig = show_note_and_display(clef, staff_index, note_info)
-            current_note = {
-                'clef': clef,
-                'staff_index': staff_index,
-                'pitch': note_info.get('pitch'),
-                'letter': note_info.get('letter'),
-                'solfege': note_info.get('solfege'),
-                'fig': fig,
-            }
-            last_shown_ts = time.time()
-
-    except KeyboardInterrupt:
+            show_next_note(state)
+
+    except (KeyboardInterrupt, EOFError):
         print("\nInterrumpido por el usuario. Adiós.")
+        # the answered attempts are already in the CSV: just say where
+        if state['mode'] == 'time' and state['session_count']:
+            print(f"Sesión guardada en: {state['session_path']}")
+        return
+    finally:
+        signal.signal(signal.SIGTERM, previous_sigterm)
+        if line_buffered:
+            sys.stdout.reconfigure(line_buffering=True)
+
+def _run_telegram(serve):
+    """Start the Telegram bot through ``serve(token=...)`` once a token is found."""
+    # Load token from file (create template if missing). If no token is found
+    # in the file, and there is a non-empty TELEGRAM_TOKEN in the script, we
+    # will warn and use that as a fallback. Otherwise, instruct the user to
+    # add the token to telegram_token.txt and exit.
+    token_from_file = _load_or_create_telegram_token()
+    if token_from_file:
+        serve(token=token_from_file)
+        return
+
+    # No token in file: check whether the script still defines a token
+    script_token = globals().get("TELEGRAM_TOKEN")
+    if script_token and str(script_token).strip():
+        print(
+            "Warning: 'telegram_token.txt' did not contain a token. Using the token embedded in the script as a fallback.\n"
+            "For better security, please place your token in 'telegram_token.txt' (non-comment line) and re-run."
+        )
+        serve(token=script_token)
         return
 
+    print(
+        "A token was not found. A template file 'telegram_token.txt' has been created in the current directory.\n"
+        "Open it and paste your bot token on a non-commented line, save, and re-run with --telegram."
+    )
+
 
 def parse_args_and_run():
+    # Las dos formas habituales de arrancar (sin argumentos, o solo
+    # --telegram, p. ej. bajo systemd) no necesitan argparse; se importa y se
+    # construye el parser solo si hay más opciones (o --help).
+    argv = sys.argv[1:]
+    if not argv:
+        local_run()
+        return
+    if argv == ["--telegram"]:
+        _run_telegram(main)
+        return
+
+    import argparse
+
     parser = argparse.ArgumentParser(description="Solfeo bot runner — local mode by default; use --telegram to run the Telegram bot")
     parser.add_argument(
         "--telegram",
         action="store_true",
         help="Run as Telegram bot (requires this flag). By default the script runs in local interactive mode.",
     )
+    parser.add_argument(
+        "--webhook",
+        metavar="URL",
+        default=None,
+        help="With --telegram: receive updates on a webhook at this public https base URL instead of polling "
+        "(requires python-telegram-bot[webhooks]).",
+    )
+    parser.add_argument(
+        "--listen",
+        default=None,
+        help=f"Address the webhook server binds to (default: {_WEBHOOK_LISTEN}).",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=None,
+        help=f"Port the webhook server listens on (default: {_WEBHOOK_PORT}).",
+    )
+    parser.add_argument(
+        "--cert",
+        metavar="PEM",
+        default=None,
+        help="TLS certificate for the webhook server. Without --cert/--key it serves plain HTTP "
+        "and needs a TLS-terminating reverse proxy in front.",
+    )
+    parser.add_argument(
+        "--key",
+        metavar="PEM",
+        default=None,
+        help="Private key matching --cert.",
+    )
     parser.add_argument(
         "--rounds",
         type=int,
@@ -1511,31 +2143,24 @@ def parse_args_and_run():
     )
     args = parser.parse_args()
 
-    if args.telegram:
-        # Load token from file (create template if missing). If no token is found
-        # in the file, and there is a non-empty TELEGRAM_TOKEN in the script, we
-        # will warn and use that as a fallback. Otherwise, instruct the user to
-        # add the token to telegram_token.txt and exit.
-        token_from_file = _load_or_create_telegram_token()
-        if token_from_file:
-            main(token=token_from_file)
-            return
-
-        # No token in file: check whether the script still defines a token
-        script_token = globals().get("TELEGRAM_TOKEN")
-        if script_token and str(script_token).strip():
-            print(
-                "Warning: 'telegram_token.txt' did not contain a token. Using the token embedded in the script as a fallback.\n"
-                "For better security, please place your token in 'telegram_token.txt' (non-comment line) and re-run."
-            )
-            main(token=script_token)
-            return
+    webhook_options = {
+        "--listen": args.listen,
+        "--port": args.port,
+        "--cert": args.cert,
+        "--key": args.key,
+    }
+    given = [opt for opt, value in webhook_options.items() if value is not None]
+    if args.webhook is None and given:
+        parser.error(f"{', '.join(given)}: only valid with --telegram --webhook")
+    if args.webhook is not None and not args.telegram:
+        parser.error("--webhook requires --telegram")
+    if (args.cert is None) != (args.key is None):
+        parser.error("--cert and --key must be given together")
 
-        print(
-            "A token was not found. A template file 'telegram_token.txt' has been created in the current directory.\n"
-            "Open it and paste your bot token on a non-commented line, save, and re-run with --telegram."
-        )
-        return
+    if args.telegram:
+        # Solo se pasan las opciones dadas: los valores por defecto son los de main()
+        webhook_kwargs = {opt.lstrip("-"): webhook_options[opt] for opt in given}
+        _run_telegram(functools.partial(main, webhook_url=args.webhook, **webhook_kwargs))
     else:
         # Run the local interactive loop (default)
         local_run(rounds=args.rounds)